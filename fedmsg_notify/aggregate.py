@@ -0,0 +1,116 @@
+# This file is a part of fedmsg-notify.
+#
+# fedmsg-notify is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# fedmsg-notify is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with fedmsg-notify.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+
+
+class Burst(object):
+    """ A run of similar messages that arrived close together """
+    __slots__ = ('key', 'count', 'packages', 'last', 'note', 'rendered',
+                 'priority', 'queued', 'call', 'expiry')
+
+    def __init__(self, key):
+        self.key = key
+        self.count = 0
+        self.packages = set()
+        self.last = None
+        self.note = None  # The summary notification, once we show one
+        self.rendered = None  # The latest message, for the summary's icon
+        self.priority = 0
+        self.queued = 0  # When the summary was last queued for display
+        self.call = None  # The pending refresh of the summary
+        self.expiry = None  # The pending close of the summary
+
+    def summary(self):
+        processor, topic = self.key[:2]
+        title = u'{} {} messages'.format(self.count, processor)
+        packages = sorted(self.packages)
+        if len(packages) == 1:
+            subtitle = u'for {}'.format(packages[0])
+        elif packages:
+            prefix = os.path.commonprefix(packages)
+            if prefix:
+                subtitle = u'for {}*'.format(prefix)
+            else:
+                subtitle = u'for {} packages'.format(len(packages))
+        else:
+            subtitle = topic
+        return title, subtitle
+
+
+class Aggregator(object):
+    """Groups storms of similar messages into summary notifications.
+
+    Messages are grouped by their processor and topic, and optionally by
+    package. The first `threshold - 1` messages of a group are shown as
+    usual. After that, the group is shown as a single summary notification,
+    which is updated in place as more messages arrive, at most once every
+    `interval` seconds. A group ends once `window` seconds pass without any
+    new messages for it.
+    """
+    interval = 1
+
+    def __init__(self, window, threshold, by_package=False):
+        self.window = window
+        self.threshold = threshold
+        self.by_package = by_package
+        self.bursts = {}  # {key: Burst}
+        self.suppressed = self.summaries = 0
+
+    def key(self, rendered):
+        key = (rendered.processor.__name__, rendered.topic)
+        if self.by_package:
+            key += (tuple(sorted(rendered.packages)),)
+        return key
+
+    def add(self, rendered):
+        """ Return the Burst to summarize this message in, or None """
+        if not self.threshold or not self.window:
+            return
+        now = time.time()
+        key = self.key(rendered)
+        burst = self.bursts.get(key)
+        if burst is None or now - burst.last > self.window:
+            self.expire(now)
+            burst = self.bursts[key] = Burst(key)
+        burst.count += 1
+        burst.last = now
+        burst.packages.update(rendered.packages)
+        burst.rendered = rendered
+        if burst.count < self.threshold:
+            return
+        if burst.count == self.threshold:
+            self.summaries += 1
+        self.suppressed += 1
+        return burst
+
+    def expire(self, now):
+        for key, burst in list(self.bursts.items()):
+            if now - burst.last > self.window:
+                del self.bursts[key]
+
+    def open_notes(self):
+        """ The summary notifications of the bursts still going on """
+        now = time.time()
+        return [burst.note for burst in self.bursts.values()
+                if burst.note is not None and now - burst.last <= self.window]
+
+    def stats(self):
+        return {
+            'bursts': len(self.bursts),
+            'summaries': self.summaries,
+            'suppressed': self.suppressed,
+        }
@@ -0,0 +1,574 @@
+# This file is a part of fedmsg-notify.
+#
+# fedmsg-notify is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# fedmsg-notify is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with fedmsg-notify.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Replay messages through the daemon, without the bus or a desktop.
+
+``fedmsg-notify-bench`` feeds recorded (or generated) messages through
+:meth:`FedmsgNotifyService.consume`, with libnotify, DBus and the ZeroMQ hub
+replaced by stubs that live in this process, and reports how many messages
+per second each scenario handles, the per-message latency of each stage,
+and the peak memory use of the process.
+
+Stage times are exclusive of each other. Messages are rendered lazily, so
+the work of rendering their icon URLs shows up in the icon stage, and the
+text in the render stage. The peak RSS is that of the whole process so far,
+so run a single scenario with ``--scenario`` to measure its memory alone.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import random
+import logging
+import argparse
+import resource
+import tempfile
+
+from collections import defaultdict
+
+import fedmsg.config
+import fedmsg.text
+import fmn.lib
+
+from fmn.lib.hinting import hint
+from twisted.internet import defer
+
+from . import daemon
+from .filters import LoadedFilter, filters
+from .icons import IconCache
+from .loaders import loaders
+from .preferences import EvaluationPlan
+from .samples import generate_messages, load_messages, packages, usernames
+
+log = logging.getLogger('moksha.hub')
+
+stages = ['decode', 'route', 'filter', 'render', 'icon', 'display']
+
+
+class StubNotification(object):
+    shown = 0
+
+    def __init__(self, title, subtitle, icon):
+        self.title, self.subtitle, self.icon = title, subtitle, icon
+
+    @classmethod
+    def new(cls, title, subtitle, icon):
+        return cls(title, subtitle, icon)
+
+    def set_hint_string(self, key, value):
+        pass
+
+    def update(self, title, subtitle, icon):
+        self.title, self.subtitle, self.icon = title, subtitle, icon
+
+    def show(self):
+        StubNotification.shown += 1
+
+    def close(self):
+        pass
+
+
+class StubNotify(object):
+    Notification = StubNotification
+
+    @staticmethod
+    def init(name):
+        return True
+
+    @staticmethod
+    def uninit():
+        pass
+
+
+class StubSettings(object):
+    """ Our GSettings, from a dict """
+
+    def __init__(self, values):
+        self.values = values
+
+    def get_string(self, key):
+        return self.values[key]
+
+    get_int = get_boolean = get_double = get_string
+
+    def connect(self, signal, callback):
+        pass
+
+
+class StubIconFetcher(object):
+    """Stores a made up icon for each URL in a real IconCache.
+
+    Each avatar gets its own content, like the real ones do, so the cost of
+    the cache's bookkeeping is included, but nothing goes over the network.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.hits = self.downloads = 0
+
+    def fetch(self, url):
+        filename = self.cache.get(url)
+        if filename:
+            self.hits += 1
+            return defer.succeed(filename)
+        self.downloads += 1
+        data = url.encode('utf-8')
+        fd, filename = tempfile.mkstemp(dir=self.cache.path, prefix='.icon-')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        digest = hashlib.sha1(data).hexdigest()
+        return defer.succeed(self.cache.add(url, filename, digest))
+
+    def stats(self):
+        return {'hits': self.hits, 'downloads': self.downloads}
+
+    def close(self):
+        pass
+
+
+class StubPreferences(object):
+    def __init__(self, plan):
+        self.plan = plan
+
+    @property
+    def preferences(self):
+        return self.plan.preferences
+
+
+class ReplayMessage(object):
+    """ A raw message, as Moksha hands them to us from ZeroMQ """
+
+    def __init__(self, topic, body):
+        self.topic = topic
+        self.body = body
+
+    def __json__(self):
+        return {'topic': self.topic, 'body': self.body}
+
+
+class StageTimer(object):
+    """Adds up the time that each message spends in each stage.
+
+    Time spent in a stage that is called from within another one only
+    counts towards the inner stage.
+    """
+
+    def __init__(self):
+        self.samples = defaultdict(list)  # {stage: [seconds per message]}
+        self.current = defaultdict(float)
+        self.stack = []
+        self.mark = 0
+
+    def wrap(self, stage, func):
+        def timed(*args, **kw):
+            self.enter(stage)
+            try:
+                return func(*args, **kw)
+            finally:
+                self.leave()
+        return timed
+
+    def enter(self, stage):
+        now = time.time()
+        if self.stack:
+            self.current[self.stack[-1]] += now - self.mark
+        self.stack.append(stage)
+        self.mark = now
+
+    def leave(self):
+        now = time.time()
+        self.current[self.stack.pop()] += now - self.mark
+        self.mark = now
+
+    def begin(self):
+        self.current.clear()
+        self.started = time.time()
+
+    def end(self):
+        self.samples['total'].append(time.time() - self.started)
+        for stage, elapsed in self.current.items():
+            self.samples[stage].append(elapsed)
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[int(round(fraction * (len(samples) - 1)))]
+
+
+# Rules for our made up FMN preferences, hinted the same way as fmn.rules
+
+@hint(categories=['buildsys'])
+def koji_builds(config, message):
+    return '.buildsys.build.' in message['topic']
+
+
+@hint(categories=['bodhi'])
+def bodhi_comments(config, message):
+    return message['topic'].endswith('.bodhi.update.comment')
+
+
+@hint(categories=['git'])
+def git_pushes(config, message):
+    return message['topic'].endswith('.git.receive')
+
+
+def user_filter(config, message, fasnick=None):
+    return fasnick in fedmsg.text.msg2usernames(message, **config)
+
+
+def package_filter(config, message, package=None):
+    return package in fedmsg.text.msg2packages(message, **config)
+
+
+def make_rule(fn, **arguments):
+    code_path = '%s:%s' % (__name__, fn.__name__)
+    return {
+        'fn': fn,
+        'created_on': 0,
+        'code_path': code_path,
+        'arguments': arguments,
+        'negated': False,
+        'cache_key': '%s:%s' % (code_path,
+                                json.dumps(arguments, sort_keys=True)),
+    }
+
+
+def make_preferences(count, seed=0):
+    """A desktop preference with `count` filters, like users set up in FMN.
+
+    Every field that the FMN server sends is filled in, the same way as
+    ``Preference.__json__`` does, so that fmn.lib.recipients can use it.
+    """
+    rand = random.Random(seed)
+    kinds = [
+        lambda: [make_rule(koji_builds),
+                 make_rule(user_filter, fasnick=rand.choice(usernames))],
+        lambda: [make_rule(bodhi_comments),
+                 make_rule(package_filter, package=rand.choice(packages))],
+        lambda: [make_rule(git_pushes),
+                 make_rule(package_filter, package=rand.choice(packages))],
+        lambda: [make_rule(user_filter, fasnick=rand.choice(usernames))],
+    ]
+    openid = 'bench.id.fedoraproject.org'
+    return [{
+        'created_on': 0,
+        'batch_delta': None,
+        'batch_count': None,
+        'markup_messages': False,
+        'triggered_by_links': True,
+        'shorten_links': False,
+        'verbose': True,
+        'enabled': True,
+        'context': {
+            'name': 'desktop',
+            'detail_name': 'openid',
+            'description': 'fedmsg-notify desktop notifications',
+            'created_on': 0,
+            'icon': 'console',
+            'placeholder': openid,
+        },
+        'user': {
+            'openid': openid,
+            'openid_url': 'http://' + openid,
+            'created_on': 0,
+        },
+        'filters': [{
+            'id': i,
+            'name': 'filter %d' % i,
+            'created_on': 0,
+            'rules': kinds[i % len(kinds)](),
+            'oneshot': False,
+        } for i in range(count)],
+        'detail_values': [openid],
+    }]
+
+
+class RecipientsPlan(object):
+    """ Matches with fmn.lib.recipients, to compare with EvaluationPlan """
+
+    def __init__(self, preferences):
+        self.preferences = preferences
+
+    def candidates(self, topic):
+        return [None]
+
+    def match(self, msg, config):
+        results = fmn.lib.recipients(self.preferences, msg, {}, config)
+        for recipients in results.values():
+            for recipient in recipients:
+                return recipient['filter_name']
+
+
+def default_settings():
+    return {
+        'enabled-filters': '[]',
+        'filter-settings': json.dumps({
+            'PackageFilter': ' '.join(packages[::3]),
+            'UsernameFilter': ' '.join(usernames[::3]),
+        }),
+        'dedup-size': 4096,
+        'dedup-window': 600,
+        'burst-window': 10,
+        'burst-threshold': 3,
+        'burst-by-package': False,
+        'display-rate': 0.0,
+        'display-burst': 5,
+        'display-queue-size': 50,
+        'user-packages-refresh': 0,
+        'reported-bugs-refresh': 0,
+    }
+
+
+def make_filter(filter, settings):
+    """ Create a filter without loading or watching its real data set """
+    if issubclass(filter, LoadedFilter):
+        return filter(settings, autoload=False)
+    return filter(settings)
+
+
+def seed_filter(loaded_filter, keys):
+    """ Give a filter the keys that it would have loaded in the background """
+    setattr(loaded_filter, loaded_filter.match_attr, set(keys))
+    loaded_filter.changed()
+
+
+def filter_keys(name, rand):
+    """ Made up keys for the filters that normally load their own """
+    if name == 'InstalledPackageFilter':
+        return ['package-%d' % i for i in range(2000)] + packages[::2]
+    if name == 'MyPackageFilter':
+        return ['package-%d' % i for i in range(200)] + packages[1::4]
+    if name == 'ReportedBugsFilter':
+        return set(1000000 + rand.randrange(500) for i in range(50))
+
+
+def signal_marshaller(member, signature):
+    """Stands in for a DBus signal, by marshalling its arguments.
+
+    This is what the real signal spends most of its time on, apart from
+    the trip through the bus.
+    """
+    import dbus.lowlevel
+
+    def emit(*args):
+        message = dbus.lowlevel.SignalMessage(
+            daemon.FedmsgNotifyService._object_path,
+            daemon.FedmsgNotifyService.bus_name, member)
+        message.append(signature=signature, *args)
+    return emit
+
+
+def make_service(scenario, config, cache_dir, options):
+    settings = default_settings()
+    service = daemon.FedmsgNotifyService.__new__(daemon.FedmsgNotifyService)
+    service.settings = StubSettings(settings)
+    service.cfg = config
+    service.topic = 'org.fedoraproject.*'
+    service.max_notifications = 10
+    service.expire = 0
+    service.notifications = []
+    service.filters = []
+    service.use_server_prefs = scenario.startswith('server-prefs')
+    service.emit_dbus_signals = scenario == 'dbus-relay'
+    service.emit_dbus_batches = scenario == 'dbus-batches'
+    service.prefs = None
+    service.icons = StubIconFetcher(IconCache(cache_dir, 20 * 1024 * 1024))
+    service.MessageReceived = signal_marshaller('MessageReceived', 'ss')
+    service.MessageReceivedBatch = signal_marshaller(
+        'MessageReceivedBatch', 'a(ss)')
+    service.make_filter = make_filter
+
+    filter_names = [f.__name__ for f in filters]
+    if scenario in filter_names:
+        enabled = [scenario]
+    else:
+        # The services, along with the relay, run on every message type
+        enabled = [p.__name__ for p in fedmsg.text.processors]
+    settings['enabled-filters'] = json.dumps(enabled)
+    service.setup_pipeline()
+
+    rand = random.Random(options.seed)
+    for loaded_filter in service.filters:
+        keys = filter_keys(loaded_filter.__class__.__name__, rand)
+        if keys is not None:
+            seed_filter(loaded_filter, keys)
+
+    if service.use_server_prefs:
+        preferences = make_preferences(options.filters, options.seed)
+        if scenario == 'server-prefs-recipients':
+            service.prefs = StubPreferences(RecipientsPlan(preferences))
+        else:
+            service.prefs = StubPreferences(EvaluationPlan(preferences))
+    return service
+
+
+def instrument(service, timer):
+    service.decode = timer.wrap('decode', service.decode)
+    service.router.processor = timer.wrap('route', service.router.processor)
+    service.router.match_service = timer.wrap(
+        'filter', service.router.match_service)
+    service.index.match = timer.wrap('filter', service.index.match)
+    if service.prefs:
+        service.prefs.plan.match = timer.wrap('filter',
+                                              service.prefs.plan.match)
+    service.format_text = timer.wrap('render', service.format_text)
+    service.fetch_icons = timer.wrap('icon', service.fetch_icons)
+    service.get_icons = timer.wrap('icon', service.get_icons)
+    service.display_notification = timer.wrap(
+        'display', service.display_notification)
+    service.display_summary = timer.wrap('display', service.display_summary)
+
+
+def flush_display(queue):
+    """ Show whatever the display queue is waiting for the reactor to show """
+    if queue.call is not None:
+        if queue.call.active():
+            queue.call.cancel()
+        queue.drain()
+
+
+def run_scenario(scenario, messages, config, options):
+    cache_dir = tempfile.mkdtemp(prefix='fedmsg-notify-bench-')
+    try:
+        service = make_service(scenario, config, cache_dir, options)
+        timer = StageTimer()
+        instrument(service, timer)
+        StubNotification.shown = 0
+        start = time.time()
+        for topic, body in messages:
+            timer.begin()
+            message = service.decode(ReplayMessage(topic, body))
+            if message is not None:
+                service.consume(message)
+                flush_display(service.display_queue)
+            timer.end()
+        service.relay.flush()
+        elapsed = time.time() - start
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    result = {
+        'messages': len(messages),
+        'seconds': elapsed,
+        'rate': elapsed and len(messages) / elapsed,
+        'decoded': service.decoded,
+        'displayed': StubNotification.shown,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'stages': {},
+    }
+    for stage in stages + ['total']:
+        samples = timer.samples.get(stage, [])
+        result['stages'][stage] = {
+            'count': len(samples),
+            'p50': percentile(samples, 0.5),
+            'p99': percentile(samples, 0.99),
+        }
+    return result
+
+
+def all_scenarios():
+    return (['services'] + [f.__name__ for f in filters] +
+            ['server-prefs', 'server-prefs-recipients',
+             'dbus-relay', 'dbus-batches'])
+
+
+def format_us(seconds):
+    if seconds is None:
+        return '-'
+    return '%.1f' % (seconds * 1e6)
+
+
+def report(results, baseline=None, out=sys.stdout):
+    out.write('%-26s %10s %9s %9s' % ('scenario', 'msgs/s', 'shown',
+                                      'rss (KB)'))
+    for stage in stages + ['total']:
+        out.write(' %17s' % ('%s p50/p99' % stage))
+    out.write('\n')
+    for scenario, result in results:
+        out.write('%-26s %10.0f %9d %9d' % (scenario, result['rate'],
+                                            result['displayed'],
+                                            result['peak_rss_kb']))
+        for stage in stages + ['total']:
+            timings = result['stages'][stage]
+            out.write(' %17s' % ('%s/%s' % (format_us(timings['p50']),
+                                            format_us(timings['p99']))))
+        if baseline and scenario in baseline:
+            before = baseline[scenario]['rate']
+            if before:
+                out.write('  %+.1f%%' % (100.0 * (result['rate'] - before) /
+                                         before))
+        out.write('\n')
+    out.write('Stage latencies are in microseconds per message.\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure how fast the daemon handles messages')
+    parser.add_argument('filename', nargs='?',
+                        help='JSON-lines file of recorded messages to replay')
+    parser.add_argument('--count', type=int, default=10000,
+                        help='How many messages to generate without a file')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--scenario', action='append',
+                        choices=all_scenarios(),
+                        help='Only run this scenario. Can be repeated.')
+    parser.add_argument('--filters', type=int, default=20,
+                        help='How many FMN filters the server-prefs '
+                        'scenarios use')
+    parser.add_argument('--json', dest='output',
+                        help='Write the results to this file')
+    parser.add_argument('--baseline',
+                        help='Compare with results written by --json')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
+
+    daemon.Notify = StubNotify
+    config = fedmsg.config.load_config(None, [])
+    fedmsg.text.make_processors(**config)
+
+    if args.filename:
+        messages = load_messages(args.filename)
+    else:
+        messages = generate_messages(args.count, args.seed)
+    # Encode the messages up front, the way they arrive off the wire
+    messages = [(msg['topic'], json.dumps(msg)) for msg in messages]
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = []
+    try:
+        for scenario in args.scenario or all_scenarios():
+            results.append((scenario,
+                            run_scenario(scenario, messages, config, args)))
+    finally:
+        # Its threads would otherwise keep us from exiting
+        loaders.stop()
+    report(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(dict(results), f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
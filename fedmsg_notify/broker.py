@@ -0,0 +1,85 @@
+# This file is a part of fedmsg-notify.
+#
+# fedmsg-notify is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# fedmsg-notify is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with fedmsg-notify.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A host-wide connection to the bus, shared by every desktop session.
+
+Rather than having each user's daemon connect to every fedmsg endpoint and
+receive the whole bus, ``fedmsg-notify-broker`` holds one set of upstream
+connections for the whole machine, and republishes them on a local socket
+for the session daemons to subscribe to, through their ``relay-endpoint``
+setting.
+
+The broker is a ZeroMQ XSUB/XPUB proxy. It passes messages along without
+decoding them, and forwards the topic subscriptions of every session
+upstream, so each session's socket-level filtering is pushed down through
+the broker to the publishers, and a message that no session wants is never
+received at all.
+"""
+
+import sys
+import logging
+import argparse
+
+import fedmsg.config
+
+log = logging.getLogger('moksha.hub')
+
+default_endpoint = 'ipc:///run/fedmsg-notify/broker'
+
+
+def run_broker(upstream, endpoint):
+    import zmq
+    context = zmq.Context()
+    frontend = context.socket(zmq.XSUB)
+    for e in upstream:
+        log.info('Connecting to %s' % e)
+        frontend.connect(e)
+    backend = context.socket(zmq.XPUB)
+    log.info('Publishing on %s' % endpoint)
+    backend.bind(endpoint)
+    try:
+        zmq.proxy(frontend, backend)
+    finally:
+        frontend.close()
+        backend.close()
+        context.term()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Share one fedmsg connection between desktop sessions')
+    parser.add_argument('--bind', default=default_endpoint,
+                        help='Where session daemons connect to (default: '
+                        '%(default)s)')
+    parser.add_argument('--upstream', action='append',
+                        help='Endpoint to receive messages from, instead of '
+                        'the ones in the fedmsg config. Can be repeated.')
+    parser.add_argument('-v', action='store_true', dest='verbose')
+    args = parser.parse_args()
+    logging.basicConfig(level=args.verbose and logging.DEBUG or logging.INFO,
+                        stream=sys.stderr)
+
+    upstream = args.upstream
+    if not upstream:
+        cfg = fedmsg.config.load_config(None, [])
+        upstream = [e for bunch in cfg['endpoints'].values() for e in bunch]
+    try:
+        run_broker(upstream, args.bind)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -22,33 +22,47 @@ gi.require_version('Gtk', '3.0')
 from twisted.internet import gtk3reactor
 gtk3reactor.install()
 from twisted.internet import reactor
-from twisted.web.client import downloadPage
-from twisted.internet import defer
+from twisted.internet import defer, task
 from twisted.internet.error import ReactorNotRunning
 
 import os
 import sys
 import json
-import uuid
+import time
 import atexit
-import shutil
+import itertools
 import psutil
-import hashlib
 import logging
+import threading
 import dbus
 import dbus.glib
 import dbus.service
-import tempfile
 import moksha.hub
 import fedmsg.text
 import fedmsg.consumers
-import fmn.lib
-import requests
 
+from collections import defaultdict
 gi.require_version('Notify', '0.7')
 from gi.repository import Notify, Gio, GLib
 
 from filters import get_enabled_filters, filters as all_filters
+from .index import MatchIndex
+from .routing import TopicRouter
+from .render import RenderedMessage
+from .icons import IconCache, IconFetcher
+from .preferences import PreferenceLoader
+from .subscriptions import SubscriptionManager, topic_prefixes
+from .dedup import Deduplicator
+from .aggregate import Aggregator, Burst
+from .display import DisplayQueue
+from .relay import SignalBatcher
+from .pipeline import Pipeline
+from .loaders import loaders
+from .scheduler import RefreshScheduler
+from .subscribers import Subscription, SubscriberIndex
+from .metrics import Histogram, flatten
+from .profiling import Profiler, measure
+from .utils import atomic_write, get_cache_dir
 
 log = logging.getLogger('moksha.hub')
 pidfile = os.path.expanduser('~/.fedmsg-notify.pid')
@@ -71,14 +85,22 @@ class FedmsgNotifyService(dbus.service.Object, fedmsg.consumers.FedmsgConsumer):
     bus_name = 'org.fedoraproject.fedmsg.notify'
     _object_path = '/org/fedoraproject/fedmsg/notify'
     msg_received_signal = 'org.fedoraproject.fedmsg.notify.MessageReceived'
-    service_filters = []  # A list of regex filters from the fedmsg text processors
+    router = None  # Maps topics to fedmsg text processors and service filters
     enabled = False
+    jsonify = False  # We decode message bodies ourselves, in _consume
     emit_dbus_signals = None  # Allow us to proxy fedmsg to dbus
+    emit_dbus_batches = None  # Proxy fedmsg to dbus in batches of messages
     enabled_filters = []
     filters = []
+    index = None  # A MatchIndex of our enabled filters
     notifications = []
+    received = rejected = decoded = 0  # Messages off the bus
+    matched = displayed = 0
+    icons = None  # An IconFetcher backed by our persistent IconCache
+    subscriptions = None  # Manages the topics our ZeroMQ sockets receive
+    stats_writer = None  # Periodically dumps our stats to a file
+    pipeline = None  # Handles messages off the main loop, when enabled
 
-    _icon_cache = {}
     __name__ = "FedmsgNotifyService"
 
     def __call__(self, hub):
@@ -91,6 +113,7 @@ class FedmsgNotifyService(dbus.service.Object, fedmsg.consumers.FedmsgConsumer):
         moksha.hub.setup_logger(verbose='-v' in sys.argv)
         self.settings = Gio.Settings.new(self.bus_name)
         self.emit_dbus_signals = self.settings.get_boolean('emit-dbus-signals')
+        self.emit_dbus_batches = self.settings.get_boolean('emit-dbus-batches')
         self.max_notifications = self.settings.get_int('max-notifications')
         self.topic = self.settings.get_string('topic')
         self.expire = self.settings.get_int('expiration')
@@ -98,8 +121,7 @@ class FedmsgNotifyService(dbus.service.Object, fedmsg.consumers.FedmsgConsumer):
         self.fmn_url = self.settings.get_string('fmn-url')
         self.use_server_prefs = self.settings.get_boolean('use-server-prefs')
         self._fmn_openid = self.settings.get_string('fmn-openid')
-        self._preferences = []
-        self._valid_paths = []
+        self.prefs = None
 
         if not self.settings.get_boolean('enabled'):
             log.info('Disabled via %r configuration, exiting...' %
@@ -118,18 +140,41 @@ class FedmsgNotifyService(dbus.service.Object, fedmsg.consumers.FedmsgConsumer):
         self.connect_signal_handlers()
 
         self.cfg = fedmsg.config.load_config(None, [])
+        # When a fedmsg-notify-broker is sharing its connection to the bus
+        # with every session on this machine, we only need to talk to it.
+        endpoints = self.settings.get_string('relay-endpoint')
+        if not endpoints:
+            endpoints = ','.join(','.join(bunch) for bunch in
+                                 self.cfg['endpoints'].values())
         moksha_options = {
             self.config_key: True,
-            "zmq_subscribe_endpoints": ','.join(
-                ','.join(bunch) for bunch in
-                self.cfg['endpoints'].values()
-            ),
+            "zmq_subscribe_endpoints": endpoints,
+            # Messages go to our own pipeline workers, which know to hand
+            # notifications back to the main loop, instead of Moksha's.
+            "moksha.blocking_mode": True,
         }
         self.cfg.update(moksha_options)
-        self.cache_dir = tempfile.mkdtemp(prefix="fedmsg-notify-daemon-")
+        self.profiler = Profiler(self.settings.get_string('profile-mode'))
+        self.icons = IconFetcher(IconCache(
+            get_cache_dir('icons'),
+            self.settings.get_int('icon-cache-size') * 1024))
 
         fedmsg.text.make_processors(**self.cfg)
-        self.settings_changed(self.settings, 'enabled-filters')
+        self.setup_pipeline()
+
+        workers = self.settings.get_int('pipeline-workers')
+        if workers > 0:
+            self.pipeline = Pipeline(
+                self.process, workers,
+                self.settings.get_int('pipeline-queue-size'),
+                self.settings.get_string('pipeline-overflow'))
+            self.pipeline.start()
+
+        if self.use_server_prefs:
+            self.prefs = PreferenceLoader(
+                self.fmn_url + self.openid + "/desktop/",
+                os.path.join(get_cache_dir(), 'preferences.json'))
+            self.prefs.reload()
 
         # Despite what fedmsg.config might say about what consumers are enabled
         # and which are not, we're only going to let the central moksha hub know
@@ -141,6 +186,12 @@ class FedmsgNotifyService(dbus.service.Object, fedmsg.consumers.FedmsgConsumer):
 
         fedmsg.consumers.FedmsgConsumer.__init__(self, moksha.hub._hub)
 
+        # Moksha has subscribed our sockets to our whole topic. Narrow that
+        # down to what our filters can actually match.
+        self.subscriptions = SubscriptionManager(
+            moksha.hub._hub, topic_prefixes(self.topic, None, self.cfg))
+        self.update_subscriptions()
+
         bus_name = dbus.service.BusName(self.bus_name, bus=self.session_bus)
         dbus.service.Object.__init__(self, bus_name, self._object_path)
 
@@ -151,22 +202,59 @@ class FedmsgNotifyService(dbus.service.Object, fedmsg.consumers.FedmsgConsumer):
         self.notifications.insert(0, note)
         self.enabled = True
 
+        stats_file = self.settings.get_string('stats-file')
+        if stats_file:
+            self.stats_writer = task.LoopingCall(
+                self.dump_stats, os.path.expanduser(stats_file))
+            self.stats_writer.start(self.settings.get_int('stats-interval'),
+                                    now=False)
+
+    def setup_pipeline(self):
+        """ Set up everything that messages pass through on their way in """
+        # Held while touching the state that every message shares, such as
+        # the dedup ring and our counters. Matching itself runs against the
+        # index, the subscribers and the FMN plan without it, as those are
+        # never changed in place.
+        self.lock = threading.Lock()
+        self.main_thread = threading.current_thread()
+        self.router = TopicRouter()
+        self.index = MatchIndex()
+        self.dedup = Deduplicator(self.settings.get_int('dedup-size'),
+                                  self.settings.get_int('dedup-window'))
+        self.aggregator = Aggregator(
+            self.settings.get_int('burst-window'),
+            self.settings.get_int('burst-threshold'),
+            self.settings.get_boolean('burst-by-package'))
+        self.display_queue = DisplayQueue(
+            self.display, self.settings.get_double('display-rate'),
+            self.settings.get_int('display-burst'),
+            self.settings.get_int('display-queue-size'))
+        self.relay = SignalBatcher(self.MessageReceivedBatch)
+        self.subscribers = SubscriberIndex()
+        self._subscription_ids = itertools.count()
+        self.filter_matches = defaultdict(int)  # {filter name: matches}
+        self.service_matches = defaultdict(int)  # {service: matches}
+        self.consume_latency = Histogram()
+        self.refresher = RefreshScheduler()
+        self.settings_changed(self.settings, 'enabled-filters')
+
     def connect_signal_handlers(self):
         self.setting_conn = self.settings.connect(
             'changed::enabled-filters', self.settings_changed)
         self.settings.connect('changed::emit-dbus-signals',
                               self.settings_changed)
+        self.settings.connect('changed::emit-dbus-batches',
+                              self.settings_changed)
         self.settings.connect('changed::filter-settings',
                               self.settings_changed)
         self.settings.connect('changed::expiration', self.settings_changed)
+        self.settings.connect('changed::topic', self.settings_changed)
 
     def settings_changed(self, settings, key):
         self.enabled_filters = get_enabled_filters(self.settings)
         if key == 'enabled-filters':
             log.debug('Reloading filter settings')
-            self.service_filters = [processor.__prefix__
-                                    for processor in fedmsg.text.processors
-                                    if processor.__name__ in self.enabled_filters]
+            self.router.set_services(self.enabled_filters)
             filter_settings = json.loads(self.settings.get_string('filter-settings'))
             enabled = [filter.__class__.__name__ for filter in self.filters]
             for filter in all_filters:
@@ -177,10 +265,21 @@ class FedmsgNotifyService(dbus.service.Object, fedmsg.consumers.FedmsgConsumer):
                     for loaded_filter in [f for f in self.filters if
                                           f.__class__.__name__ == name]:
                         self.filters.remove(loaded_filter)
+                        self.index.remove(loaded_filter)
+                        self.refresher.remove(loaded_filter)
+                        loaded_filter.close()
                 # Initialize any filters that were just enabled
                 if name not in enabled and name in self.enabled_filters:
                     log.debug('Initializing filter: %s' % name)
-                    self.filters.append(filter(filter_settings.get(name, '')))
+                    loaded_filter = self.make_filter(
+                        filter, filter_settings.get(name, ''))
+                    self.filters.append(loaded_filter)
+                    self.index.add(loaded_filter)
+                    refresh_key = loaded_filter.__refresh_key__
+                    if refresh_key:
+                        self.refresher.add(loaded_filter,
+                                           self.settings.get_int(refresh_key))
+            self.update_subscriptions()
         elif key == 'filter-settings':
             # We don't want to re-initialize all of our filters here, because
             # this could happen for every keystroke the user types in a text
@@ -189,11 +288,37 @@ class FedmsgNotifyService(dbus.service.Object, fedmsg.consumers.FedmsgConsumer):
             pass
         elif key == 'emit-dbus-signals':
             self.emit_dbus_signals = settings.get_boolean(key)
+        elif key == 'emit-dbus-batches':
+            self.emit_dbus_batches = settings.get_boolean(key)
+            if not self.emit_dbus_batches:
+                self.relay.flush()
         elif key == 'expiration':
             self.expire = self.settings.get_int('expiration')
+        elif key == 'topic':
+            self.topic = self.settings.get_string('topic')
+            self.update_subscriptions()
         else:
             log.warn('Unknown setting changed: %s' % key)
 
+    def make_filter(self, filter, settings):
+        return filter(settings)
+
+    def update_subscriptions(self):
+        """ Only subscribe to the topics that could match our filters """
+        if not self.subscriptions:
+            return
+        processors = extra = None
+        if not self.use_server_prefs and not self.index:
+            # Without any advanced filters, only messages for the services
+            # that the user enabled can match, along with whatever our DBus
+            # subscribers asked for.
+            processors = self.router.services.values()
+            extra = self.subscribers.prefixes()
+            if extra is None:
+                processors = None
+        self.subscriptions.update(
+            topic_prefixes(self.topic, processors, self.cfg, extra or ()))
+
     @property
     def username(self):
         import fedora_cert
@@ -208,39 +333,106 @@ class FedmsgNotifyService(dbus.service.Object, fedmsg.consumers.FedmsgConsumer):
 
     @property
     def preferences(self):
-        def repopulate_functions(preference):
-            for fltr in preference['filters']:
-                for rule in fltr['rules']:
-                    code_path = str(rule['code_path'])
-                    rule['fn'] = fedmsg.utils.load_class(code_path)
+        return self.prefs.preferences
 
-            return preference
-
-
-        if not self._preferences:
-            url = self.fmn_url + self.openid + "/desktop/"
-            log.info("Getting preferences from %s" % url)
+    def accepts(self, topic):
+        """ Whether a message on this topic could possibly match """
+        if self.subscribers and self.subscribers.match_topic(topic):
+            return True
+        if self.use_server_prefs:
+            return '.fmn.' in topic or bool(self.prefs.plan.candidates(topic))
+        if self.index:
+            # Our advanced filters need to look inside the message body
+            return True
+        processor = self.router.processor({'topic': topic})
+        return bool(self.router.match_service(topic, processor))
+
+    def decode(self, message):
+        """Reject messages based on their topic before decoding their body.
+
+        Moksha hands us each raw message from the bus. Most of them can be
+        thrown away by looking at their topic alone, so we only decode the
+        bodies of the rest, and keep the original JSON around so that we
+        don't have to encode it again to relay it over DBus. Returns None
+        for messages that we don't want.
+        """
+        if not hasattr(message, '__json__'):
+            return message
+        topic, raw = message.topic, message.body
+        if not self.accepts(topic):
+            with self.lock:
+                self.rejected += 1
+            return
+        try:
+            body = json.loads(raw)
+        except ValueError:
+            log.debug('Unable to decode message body: %r' % raw)
+            return
+        with self.lock:
+            self.decoded += 1
+        return {'topic': topic, 'body': body, 'raw': raw}
+
+    def _consume(self, message):
+        self.received += 1
+        if self.pipeline is not None:
+            self.pipeline.put(getattr(message, 'topic', None), message)
+        else:
+            return self.process(message)
 
-            response = requests.get(url)
-            if not response:
-                log.warning("Failed with %r" % response)
-                return []
+    def process(self, message):
+        """ Decode, check and handle a message, in whichever thread we're in """
+        message = self.decode(message)
+        if message is not None:
+            return fedmsg.consumers.FedmsgConsumer._consume(self, message)
 
-            preference = response.json()
-            preference = repopulate_functions(preference)
-            self._preferences = [preference]
-        return self._preferences
+    def in_main_loop(self, func, *args):
+        """Call func on the main loop, where we can talk to DBus and GTK.
 
-    @property
-    def valid_paths(self):
-        if not self._valid_paths:
-            self._valid_paths = fmn.lib.load_rules(root="fmn.rules")
-        return self._valid_paths
+        Neither Twisted's reactor nor libnotify can be used from other
+        threads, so whatever handles messages off the main loop hands its
+        notifications and signals back through here.
+        """
+        if threading.current_thread() is self.main_thread:
+            return func(*args)
+        reactor.callFromThread(func, *args)
 
     def consume(self, msg):
         """ Called by fedmsg (Moksha) with each message as they arrive """
-        msg, topic = msg.get('body'), msg.get('topic')
+        start = time.time()
+        try:
+            self.handle(msg)
+        finally:
+            duration = time.time() - start
+            with self.lock:
+                self.consume_latency.observe(duration)
+
+    def handle(self, msg):
+        msg, topic, raw = msg.get('body'), msg.get('topic'), msg.get('raw')
+
+        with self.lock:
+            duplicate = self.dedup.is_duplicate(msg.get('msg_id'))
+        if duplicate:
+            log.debug('Skipping duplicate message %s' % msg.get('msg_id'))
+            return
+        processor = self.router.processor(msg)
+        subscriptions = (self.subscribers and
+                         self.subscribers.match(msg, processor))
+        priority = self.match(msg, topic, processor)
+        if priority is None and not subscriptions:
+            return
 
+        rendered = RenderedMessage(msg, processor, self.cfg, raw)
+        if threading.current_thread() is not self.main_thread:
+            # Leave the main loop with nothing to do but show it
+            rendered.render()
+        if subscriptions:
+            self.in_main_loop(self.publish, subscriptions, topic,
+                              rendered.json)
+        if priority is not None:
+            self.in_main_loop(self.deliver, topic, rendered, priority)
+
+    def match(self, msg, topic, processor):
+        """ Return the priority to show this message with, or None """
         # Here we have two totally different methods for determining what
         # messages to show.  One way allows using preferences as queried from a
         # web service, namely https://apps.fedoraproject.org/notifications
@@ -250,74 +442,159 @@ class FedmsgNotifyService(dbus.service.Object, fedmsg.consumers.FedmsgConsumer):
                 openid = msg['msg']['openid']
                 if openid == self.openid:
                     log.info("Noticed a pref change for %s", openid)
-                    self._preferences = None  # This will trigger a reload.
+                    self.in_main_loop(self.prefs.reload)
 
-            recipients = fmn.lib.recipients(
-                self.preferences, msg, self.valid_paths, self.cfg)
+            matched = self.prefs.plan.match(msg, self.cfg)
 
-            if not recipients:
+            if not matched:
                 log.debug("Message to %s didn't match filters" % topic)
                 return
+            log.debug('Matched topic %s with %s' % (topic, matched))
+            matches, priority = self.filter_matches, 1
         else:
-            processor = fedmsg.text.msg2processor(msg)
-            for filter in self.filters:
-                if filter.match(msg, processor):
-                    log.debug('Matched topic %s with %s' % (topic, filter))
-                    break
+            filter = self.index.match(msg, processor)
+            if filter:
+                log.debug('Matched topic %s with %s' % (topic, filter))
+                matches, priority = self.filter_matches, filter.__priority__
+                matched = filter.__class__.__name__
+            elif self.router.match_service(topic, processor):
+                log.debug('Matched topic %s with %s' % (
+                    topic, processor.__prefix__.pattern))
+                matches, priority = self.service_matches, 0
+                matched = processor.__name__.lower()
             else:
-                for filter in self.service_filters:
-                    if filter.match(topic):
-                        log.debug('Matched topic %s with %s' % (topic, filter.pattern))
-                        break
-                else:
-                    log.debug("Message to %s didn't match filters" % topic)
-                    return
+                log.debug("Message to %s didn't match filters" % topic)
+                return
+
+        with self.lock:
+            matches[matched] += 1
+            self.matched += 1
+        return priority
 
+    def publish(self, subscriptions, topic, body):
+        for subscription in subscriptions:
+            subscription.MessageReceived(topic, body)
 
+    def deliver(self, topic, rendered, priority):
         if self.emit_dbus_signals:
-            self.MessageReceived(topic, json.dumps(msg))
+            self.MessageReceived(topic, rendered.json)
+        if self.emit_dbus_batches:
+            self.relay.add(topic, rendered.json)
 
-        self.notify(msg)
+        self.notify(rendered, priority)
 
     @dbus.service.signal(dbus_interface=bus_name, signature='ss')
     def MessageReceived(self, topic, body):
         pass
 
-    def notify(self, msg):
-        d = self.fetch_icons(msg)
-        d.addCallbacks(self.display_notification, errback=log.error,
-                       callbackArgs=(msg,))
+    @dbus.service.signal(dbus_interface=bus_name, signature='a(ss)')
+    def MessageReceivedBatch(self, messages):
+        pass
 
-    def display_notification(self, results, body, *args, **kw):
-        pretty_text = fedmsg.text.msg2repr(body, **self.cfg)
-        log.debug(pretty_text)
-        title, subtitle = self.format_text(body)
-        icon, secondary_icon = self.get_icons(body)
+    def notify(self, rendered, priority=0):
+        # Messages about the user's own packages and bugs are always shown
+        # on their own
+        if priority <= 1:
+            burst = self.aggregator.add(rendered)
+            if burst is not None:
+                burst.priority = max(burst.priority, priority)
+                self.refresh_summary(burst)
+                return
+        self.display_queue.put(rendered, priority)
+
+    def refresh_summary(self, burst):
+        """ Queue the summary of a burst, at most once per interval """
+        if burst.call is not None:
+            return  # The pending refresh will include this message
+        delay = burst.queued + self.aggregator.interval - time.time()
+        if delay > 0:
+            burst.call = reactor.callLater(delay, self.queue_summary, burst)
+        else:
+            self.queue_summary(burst)
+
+    def queue_summary(self, burst):
+        burst.call = None
+        burst.queued = time.time()
+        self.display_queue.put(burst, burst.priority)
+
+    def display(self, item):
+        if isinstance(item, Burst):
+            return self.display_summary(item)
+        rendered = item
+        pinned = []  # The icons to keep around until we have shown them
+        d = self.fetch_icons(rendered, pinned)
+        d.addCallbacks(self.display_notification, errback=log.error,
+                       callbackArgs=(rendered,))
+        d.addBoth(lambda result: self.icons.cache.unpin(pinned))
+
+    def display_notification(self, results, rendered, *args, **kw):
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(rendered.repr)
+        title, subtitle = self.format_text(rendered)
+        icon, secondary_icon = self.get_icons(rendered)
         note = Notify.Notification.new(title, subtitle, icon)
         if secondary_icon:
             note.set_hint_string('image-path', secondary_icon)
+        self.show(note)
+
+    def display_summary(self, burst):
+        """ Show or update the summary notification of a burst of messages """
+        title, subtitle = burst.summary()
+        icon, secondary_icon = self.get_icons(burst.rendered)
+        if burst.note is None:
+            burst.note = Notify.Notification.new(title, subtitle, icon)
+            burst.expiry = self.show(burst.note)
+            return
+        burst.note.update(title, subtitle, icon)
+        try:
+            burst.note.show()
+        except:
+            log.exception('Unable to update notification')
+            return
+        self.keep(burst.note)
+        # Give the summary its full time on screen after every update
+        if burst.expiry is not None and burst.expiry.active():
+            burst.expiry.cancel()
+        if self.expire:
+            burst.expiry = reactor.callLater(self.expire, burst.note.close)
+
+    def show(self, note):
+        """ Show a notification, returning the call that will close it """
         try:
             note.show()
-            self.notifications.insert(0, note)
-            if len(self.notifications) >= self.max_notifications:
-                self.notifications.pop().close()
+            self.displayed += 1
+            self.keep(note)
             if self.expire:
-                reactor.callLater(self.expire, note.close)
+                return reactor.callLater(self.expire, note.close)
         except:
             log.exception('Unable to display notification')
 
-    def format_text(self, body):
-        title = fedmsg.text.msg2title(body, **self.cfg) or ''
-        subtitle = fedmsg.text.msg2subtitle(body, **self.cfg) or ''
-        link = fedmsg.text.msg2link(body, **self.cfg) or ''
+    def keep(self, note):
+        """ Remember a notification, closing the oldest if there are too many
+
+        The summaries of bursts that are still going on are never closed.
+        """
+        if note in self.notifications:
+            self.notifications.remove(note)
+        self.notifications.insert(0, note)
+        if len(self.notifications) < self.max_notifications:
+            return
+        open_notes = self.aggregator.open_notes()
+        for old in reversed(self.notifications):
+            if old not in open_notes:
+                self.notifications.remove(old)
+                old.close()
+                break
+
+    def format_text(self, rendered):
+        title, subtitle, link = rendered.title, rendered.subtitle, rendered.link
         if link:
             subtitle = u'{} {}'.format(subtitle, link)
         return title, subtitle
 
-    def get_icons(self, body):
-        icon = self._icon_cache.get(fedmsg.text.msg2icon(body, **self.cfg))
-        secondary_icon = self._icon_cache.get(
-            fedmsg.text.msg2secondary_icon(body, **self.cfg))
+    def get_icons(self, rendered):
+        icon = self.icons.cache.get(rendered.icon)
+        secondary_icon = self.icons.cache.get(rendered.secondary_icon)
         ico = hint = None
         if secondary_icon:
             ico = secondary_icon
@@ -326,50 +603,148 @@ class FedmsgNotifyService(dbus.service.Object, fedmsg.consumers.FedmsgConsumer):
             ico = hint = icon
         return ico, hint
 
-    def fetch_icons(self, msg):
+    def fetch_icons(self, rendered, pinned):
         icons = []
-        icon = fedmsg.text.msg2icon(msg, **self.cfg)
-        if icon:
-            icons.append(self.get_icon(icon))
-        secondary_icon = fedmsg.text.msg2secondary_icon(msg, **self.cfg)
-        if secondary_icon:
-            icons.append(self.get_icon(secondary_icon))
+        for url in (rendered.icon, rendered.secondary_icon):
+            if url:
+                d = self.get_icon(url)
+                d.addCallback(self.pin_icon, url, pinned)
+                icons.append(d)
         return defer.DeferredList(icons)
 
+    def pin_icon(self, filename, url, pinned):
+        """ Keep a downloaded icon from being evicted before it is shown """
+        digest = self.icons.cache.pin(url)
+        if digest is not None:
+            pinned.append(digest)
+        return filename
+
     def get_icon(self, icon):
-        icon_file = self._icon_cache.get(icon)
-        if not icon_file:
-            icon_id = str(uuid.uuid5(uuid.NAMESPACE_URL, str(icon)))
-            filename = os.path.join(self.cache_dir, icon_id)
-            if not os.path.exists(filename):
-                log.debug('Downloading icon: %s' % icon)
-                d = downloadPage(str(icon), filename)
-                d.addCallbacks(self.cache_icon, errback=log.error,
-                               callbackArgs=(icon, filename))
-                return d
-            else:
-                self._icon_cache[icon] = filename
-        d = defer.Deferred()
-        d.callback(None)
-        return d
-
-    def cache_icon(self, results, icon_url, filename):
-        if not os.path.exists(filename):
-            log.debug('Failed to download %s' % icon_url)
+        return self.icons.fetch(icon)
+
+    @dbus.service.method(bus_name, in_signature='asasas', out_signature='o',
+                         sender_keyword='sender')
+    def Subscribe(self, topic_prefixes, packages, usernames, sender=None):
+        """Subscribe to a filtered stream of messages.
+
+        Returns the object path of the new subscription, which emits a
+        MessageReceived signal for each matching message. Topic prefixes
+        match whole parts of the topic, and ``*`` matches every topic. The
+        subscription lasts until its Unsubscribe method is called, or the
+        caller leaves the bus.
+        """
+        path = '%s/subscriptions/%d' % (self._object_path,
+                                        next(self._subscription_ids))
+        subscription = Subscription(self.session_bus, path, sender,
+                                    topic_prefixes, packages, usernames)
+        subscription.on_unsubscribe = self.remove_subscription
+        if sender:
+            def owner_changed(owner):
+                if not owner:
+                    self.remove_subscription(subscription)
+            subscription.watch = self.session_bus.watch_name_owner(
+                sender, owner_changed)
+        self.subscribers.add(subscription)
+        self.update_subscriptions()
+        log.info('Added subscription %r' % subscription)
+        return path
+
+    def remove_subscription(self, subscription):
+        if subscription not in self.subscribers.subscriptions:
             return
-        cache = self._icon_cache
-        checksum = self.hash_file(filename)
-        if checksum in cache:
-            cache[icon_url] = cache[checksum]
-            os.unlink(filename)
-        else:
-            cache[icon_url] = cache[checksum] = filename
+        log.info('Removing subscription %r' % subscription)
+        self.subscribers.remove(subscription)
+        if subscription.watch:
+            subscription.watch.cancel()
+        subscription.remove_from_connection()
+        self.update_subscriptions()
+
+    def get_stats(self):
+        stats = {
+            'messages': {
+                'received': self.received,
+                'rejected': self.rejected,
+                'decoded': self.decoded,
+                'duplicates': self.dedup.duplicates,
+                'matched': self.matched,
+                'displayed': self.displayed,
+            },
+            'matches': {
+                'filters': dict(self.filter_matches),
+                'services': dict(self.service_matches),
+            },
+            'consume_latency': self.consume_latency.stats(),
+            'router': self.router.stats(),
+            'dedup': self.dedup.stats(),
+            'bursts': self.aggregator.stats(),
+            'display': self.display_queue.stats(),
+            'relay': self.relay.stats(),
+            'icons': self.icons.stats(),
+            'filters': dict((f.__class__.__name__, f.stats())
+                            for f in self.filters),
+            'next_refresh': self.refresher.stats(),
+            'loaders': loaders.stats(),
+            'subscribers': len(self.subscribers),
+            'notifications': len(self.notifications),
+        }
+        if self.pipeline:
+            stats['pipeline'] = self.pipeline.stats()
+        if self.subscriptions:
+            stats['subscriptions'] = self.subscriptions.stats()
+        if self.prefs:
+            stats['preferences'] = self.prefs.stats()
+            stats['plan'] = self.prefs.plan.stats()
+        return stats
+
+    @dbus.service.method(bus_name, out_signature='a{sv}')
+    def GetStats(self):
+        """Return our counters and histograms.
+
+        Nested stats are flattened into dotted keys, such as
+        ``messages.received`` or ``icons.download_latency.buckets.le_0.1``.
+        """
+        return flatten(self.get_stats())
+
+    def dump_stats(self, filename):
+        try:
+            atomic_write(filename, json.dumps(self.get_stats(), indent=2,
+                                              sort_keys=True))
+        except (IOError, OSError):
+            log.exception('Unable to write stats to %s' % filename)
+
+    @dbus.service.method(bus_name, in_signature='u', out_signature='b')
+    def StartProfile(self, seconds):
+        """Profile the daemon for this many seconds.
+
+        Returns False if a profile is already running.
+        """
+        return self.profiler.start(seconds)
+
+    @dbus.service.method(bus_name, in_signature='s', out_signature='as')
+    def DumpProfile(self, path):
+        """ Write the last profile to a file, returning the files written """
+        return self.profiler.dump(os.path.expanduser(path))
+
+    def memory_stats(self):
+        """ The sizes of the data that we keep around """
+        return {
+            'icon_cache': measure(self.icons.cache.entries),
+            'notifications': measure(self.notifications),
+            'dedup': measure(self.dedup.seen),
+            'routes': measure(self.router.routes),
+            'bursts': measure(self.aggregator.bursts),
+            'filters': dict((repr(f), measure(f.keys()))
+                            for f in self.filters),
+            'index': dict((attr, measure(table)) for attr, table
+                          in self.index.tables.items()),
+        }
 
-    def hash_file(self, filename):
-        md5 = hashlib.md5(usedforsecurity=False)
-        with open(filename) as f:
-            md5.update(f.read())
-        return md5.hexdigest()
+    @dbus.service.method(bus_name, in_signature='s')
+    def DumpMemory(self, path):
+        """ Write the sizes of our caches and data sets to a JSON file """
+        atomic_write(os.path.expanduser(path),
+                     json.dumps(self.memory_stats(), indent=2,
+                                sort_keys=True))
 
     @dbus.service.method(bus_name)
     def Enable(self, *args, **kw):
@@ -390,11 +765,18 @@ class FedmsgNotifyService(dbus.service.Object, fedmsg.consumers.FedmsgConsumer):
         except GLib.GError:  # Bug 1053160
             pass
 
+        if self.pipeline:
+            self.pipeline.stop()
         Notify.uninit()
+        self.relay.flush()
+        if self.stats_writer and self.stats_writer.running:
+            self.stats_writer.stop()
+        self.profiler.stop()
 
         super(FedmsgNotifyService, self).stop()
 
-        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        self.icons.cache.save()
+        self.icons.close()
         if os.path.exists(pidfile):
             os.unlink(pidfile)
 
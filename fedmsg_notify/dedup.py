@@ -0,0 +1,64 @@
+# This file is a part of fedmsg-notify.
+#
+# fedmsg-notify is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# fedmsg-notify is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with fedmsg-notify.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+
+
+class Deduplicator(object):
+    """Remembers the msg_ids of the last `size` messages that we have seen.
+
+    We connect to every endpoint in the fedmsg config, so relays, gateways
+    and restarts regularly hand us the same message more than once. The ids
+    are kept in a fixed-size ring, alongside a dict for fast lookups, so our
+    memory use stays the same no matter how fast messages arrive. A message
+    only counts as a duplicate if we saw it less than `window` seconds ago.
+    """
+
+    def __init__(self, size, window=None):
+        self.size = max(size, 1)
+        self.window = window
+        self.ring = [None] * self.size
+        self.pos = 0
+        self.seen = {}  # {msg_id: when we last saw it}
+        self.duplicates = self.unique = 0
+
+    def is_duplicate(self, msg_id):
+        if msg_id is None:
+            return False
+        now = time.time()
+        last_seen = self.seen.get(msg_id)
+        if last_seen is not None:
+            if not self.window or now - last_seen < self.window:
+                self.duplicates += 1
+                return True
+        else:
+            oldest = self.ring[self.pos]
+            if oldest is not None:
+                del self.seen[oldest]
+            self.ring[self.pos] = msg_id
+            self.pos = (self.pos + 1) % self.size
+        self.seen[msg_id] = now
+        self.unique += 1
+        return False
+
+    def stats(self):
+        total = self.duplicates + self.unique
+        return {
+            'size': self.size,
+            'tracked': len(self.seen),
+            'duplicates': self.duplicates,
+            'unique': self.unique,
+            'hit_rate': total and float(self.duplicates) / total,
+        }
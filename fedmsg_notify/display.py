@@ -0,0 +1,127 @@
+# This file is a part of fedmsg-notify.
+#
+# fedmsg-notify is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# fedmsg-notify is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with fedmsg-notify.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import heapq
+import logging
+import itertools
+
+from twisted.internet import reactor
+
+from .metrics import Histogram
+
+log = logging.getLogger('moksha.hub')
+
+
+class TokenBucket(object):
+    """ Allows `rate` events per second, in bursts of up to `burst`.
+
+    A `rate` of 0 disables the limit.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.last = time.time()
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def consume(self):
+        if not self.rate:
+            return True
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def delay(self):
+        """ How many seconds until the next token is available """
+        self._refill()
+        return max(0, (1 - self.tokens) / self.rate)
+
+
+class DisplayQueue(object):
+    """A bounded, prioritized queue of messages waiting to be displayed.
+
+    Messages are handed to `display` no faster than the token bucket allows,
+    highest priority first. When the queue is full, the lowest priority
+    message is dropped to make room, so broad topic matches are shed before
+    the messages about the user's own bugs and username.
+    """
+
+    def __init__(self, display, rate, burst, size):
+        self.display = display
+        self.bucket = TokenBucket(rate, burst)
+        self.size = max(size, 1)
+        self.heap = []  # [(-priority, sequence, enqueued at, item)]
+        self.counter = itertools.count()
+        self.call = None
+        self.shown = self.dropped = 0
+        self.total_wait = self.max_wait = 0.0
+        self.max_depth = 0
+        self.wait = Histogram()  # How long messages wait to be displayed
+
+    def put(self, item, priority=0):
+        entry = (-priority, next(self.counter), time.time(), item)
+        if len(self.heap) >= self.size:
+            lowest = max(self.heap)
+            self.dropped += 1
+            if entry[0] >= lowest[0]:
+                # Nothing queued is less important than this message
+                log.debug('Display queue full, dropping %r' % (item,))
+                return
+            log.debug('Display queue full, dropping %r' % (lowest[3],))
+            self.heap.remove(lowest)
+            heapq.heapify(self.heap)
+        heapq.heappush(self.heap, entry)
+        self.max_depth = max(self.max_depth, len(self.heap))
+        self.schedule()
+
+    def schedule(self):
+        if self.call is None and self.heap:
+            self.call = reactor.callLater(0, self.drain)
+
+    def drain(self):
+        self.call = None
+        while self.heap and self.bucket.consume():
+            priority, _, enqueued, item = heapq.heappop(self.heap)
+            wait = time.time() - enqueued
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            self.wait.observe(wait)
+            self.shown += 1
+            try:
+                self.display(item)
+            except Exception:
+                log.exception('Unable to display %r' % (item,))
+        if self.heap:
+            self.call = reactor.callLater(self.bucket.delay(), self.drain)
+
+    def stats(self):
+        return {
+            'depth': len(self.heap),
+            'max_depth': self.max_depth,
+            'shown': self.shown,
+            'dropped': self.dropped,
+            'max_wait': self.max_wait,
+            'mean_wait': self.shown and self.total_wait / self.shown,
+            'wait': self.wait.stats(),
+        }
@@ -39,6 +39,27 @@ except NameError:
         """Retrieve the packages installed on the system"""
         return []
 
+try:
+    get_package_databases
+except NameError:
+    def get_package_databases():
+        """The files that change when packages are installed or removed"""
+        return []
+
+try:
+    get_problem_files
+except NameError:
+    def get_problem_files():
+        """The files that change when ABRT reports a problem somewhere"""
+        return []
+
+try:
+    get_problem_count
+except NameError:
+    def get_problem_count():
+        """How many problems ABRT lets us see, or None without ABRT"""
+        return None
+
 try:
     get_user_packages
 except NameError:
@@ -17,38 +17,58 @@
 # Authors: Nicolas Dandrimont <nicolas.dandrimont@crans.org>
 
 from collections import defaultdict
-from cStringIO import StringIO
 import email.utils
-import gzip
+import httplib
+import json
 import logging
+import mmap
+import os
 import urllib2
+import zlib
 
 import deb822
 
+from ..utils import atomic_write, get_cache_dir
 
-UPLOADERS = defaultdict(set)
-log = logging.getLogger('moksha.hub')
-
-
-def _populate_uploaders():
-    """Populate the uploaders dict with uploaders"""
-    UPLOADERS_URI = "http://http.debian.net/debian/indices/Uploaders.gz"
 
-    f = urllib2.urlopen(UPLOADERS_URI)
-
-    if f.getcode() != 200:
-        log.warn("Could not retrieve uploaders URI: error %s" % f.getcode())
-        return
+UPLOADERS_URI = "http://http.debian.net/debian/indices/Uploaders.gz"
+log = logging.getLogger('moksha.hub')
 
-    gzip_file = gzip.GzipFile(fileobj=StringIO(f.read()))
 
-    UPLOADERS.clear()
+def _gunzip_lines(f, chunk_size=65536, length=None):
+    """Decompress a gzipped file-like object as it is read, line by line
 
-    for line in gzip_file.readlines():
+    zlib doesn't complain about a stream that stops short, so when we know
+    how long it should be, raise IOError if we got less than that.
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    pending = ''
+    read = 0
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        read += len(chunk)
+        lines = (pending + decompressor.decompress(chunk)).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line
+    if length is not None and read < length:
+        raise IOError("Truncated download, got %d of %d bytes" % (read, length))
+    for line in (pending + decompressor.flush()).split('\n'):
+        if line:
+            yield line
+
+
+def _parse_uploaders(lines):
+    """Map every way of referring to an uploader to their packages"""
+    uploaders = defaultdict(set)
+    for line in lines:
         try:
             package, uploader = line.strip().split(None, 1)
         except ValueError:
             continue
+        package = intern(package)
 
         uploader_name, uploader_email = email.utils.parseaddr(uploader)
         try:
@@ -56,38 +76,146 @@ def _populate_uploaders():
         except ValueError:
             uploader_domain = ""
 
-        UPLOADERS[uploader].add(package)
-        UPLOADERS[uploader_email].add(package)
+        uploaders[uploader].add(package)
+        uploaders[uploader_email].add(package)
         if uploader_name:
-            UPLOADERS[uploader_name].add(package)
+            uploaders[uploader_name].add(package)
         if uploader_domain == "debian.org":
-            UPLOADERS[uploader_localpart].add(package)
+            uploaders[uploader_localpart].add(package)
+    return uploaders
+
+
+def _write_index(filename, uploaders):
+    """Write the uploaders out as sorted `key\tpackage package...` lines"""
+    lines = []
+    for key in sorted(k for k in uploaders if k and '\t' not in k):
+        lines.append('%s\t%s\n' % (key, ' '.join(sorted(uploaders[key]))))
+    atomic_write(filename, ''.join(lines))
+
+
+def _lookup(index, key):
+    """Binary search the sorted lines of an index for this key's packages"""
+    lo, hi = 0, len(index)
+    # Every line before `lo` sorts before the key, and every line from `hi`
+    # onwards doesn't.
+    while lo < hi:
+        mid = (lo + hi) // 2
+        newline = index.rfind('\n', lo, mid)
+        start = lo if newline == -1 else newline + 1
+        end = index.find('\n', start)
+        if end == -1:
+            end = len(index)
+        if index[start:index.find('\t', start, end)] < key:
+            lo = end + 1
+        else:
+            hi = start
+    end = index.find('\n', lo)
+    if end == -1:
+        end = len(index)
+    line_key, _, packages = index[lo:end].partition('\t')
+    if line_key == key:
+        return packages.split()
+    return []
+
+
+def _update_uploaders(cache_dir):
+    """Download Uploaders.gz if it has changed, and rebuild our index of it"""
+    index_file = os.path.join(cache_dir, 'uploaders.idx')
+    meta_file = os.path.join(cache_dir, 'uploaders.json')
+    try:
+        with open(meta_file) as f:
+            meta = json.load(f)
+    except (IOError, ValueError):
+        meta = {}
+
+    request = urllib2.Request(UPLOADERS_URI)
+    if os.path.exists(index_file):
+        if meta.get('etag'):
+            request.add_header('If-None-Match', meta['etag'])
+        if meta.get('last_modified'):
+            request.add_header('If-Modified-Since', meta['last_modified'])
+    try:
+        f = urllib2.urlopen(request, timeout=60)
+    except urllib2.HTTPError as e:
+        if e.code == 304:
+            log.debug("Uploaders index is up to date")
+        else:
+            log.warn("Could not retrieve uploaders URI: error %s" % e.code)
+        return
+    except urllib2.URLError as e:
+        log.warn("Could not retrieve uploaders URI: %s" % e.reason)
+        return
+    except (IOError, httplib.HTTPException) as e:
+        log.warn("Could not retrieve uploaders URI: %s" % e)
+        return
+
+    try:
+        length = f.info().getheader('Content-Length')
+        lines = _gunzip_lines(f, length=length and int(length))
+        _write_index(index_file, _parse_uploaders(lines))
+        atomic_write(meta_file, json.dumps({
+            'etag': f.info().getheader('ETag'),
+            'last_modified': f.info().getheader('Last-Modified'),
+        }))
+    except (IOError, OSError, ValueError, httplib.HTTPException,
+            zlib.error) as e:
+        # The index is only swapped in once it is complete, so we keep
+        # serving the one we had
+        log.warn("Could not rebuild the uploaders index: %s" % e)
+        return
+    finally:
+        f.close()
+    log.info("Rebuilt the Debian uploaders index")
+
+
+DPKG_STATUS = "/var/lib/dpkg/status"
+
+
+def get_package_databases():
+    """The files that change when packages are installed or removed"""
+    return [DPKG_STATUS]
 
 
 def get_installed_packages():
-    """Retrieve the packages installed on the system"""
-    STATE_FILE = "/var/lib/apt/extended_states"
-    with open(STATE_FILE) as f:
-        installed_packages = deb822.Deb822.iter_paragraphs(f)
-        for package in installed_packages:
-            if "Auto-Installed" in package and package["Auto-Installed"] == 1:
-                continue
-            yield package["Package"]
+    """Retrieve the packages installed on the system, from dpkg's status"""
+    packages = set()
+    with open(DPKG_STATUS) as f:
+        for package in deb822.Deb822.iter_paragraphs(
+                f, fields=["Package", "Status"]):
+            if package.get("Status", "").endswith(" installed"):
+                packages.add(package["Package"])
+    return packages
 
 
 def get_user_packages(usernames):
     """
     Retrieve the packages maintained by people matching one of the `usernames`.
 
-    We retrieve an Uploaders indice from a mirror and cache it.
+    We keep the Uploaders indice from a mirror in an index on disk, sorted
+    by uploader, and only download it again when the mirror's copy has
+    changed. Lookups binary search the mmapped index, so the uploaders are
+    never all loaded into memory, and the index is shared by every daemon
+    through the page cache.
     """
-    if not UPLOADERS:
-        _populate_uploaders()
+    cache_dir = get_cache_dir('debian')
+    _update_uploaders(cache_dir)
 
     packages = set()
-    for username in usernames:
-        packages |= UPLOADERS[username]
-
+    try:
+        f = open(os.path.join(cache_dir, 'uploaders.idx'))
+    except IOError:
+        return packages
+    with f:
+        if not os.fstat(f.fileno()).st_size:
+            return packages
+        index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for username in usernames:
+                if isinstance(username, unicode):
+                    username = username.encode('utf-8')
+                packages.update(_lookup(index, username))
+        finally:
+            index.close()
     return packages
 
 
@@ -16,10 +16,17 @@
 # Copyright (C) 2012, 2013 Red Hat, Inc.
 # Authors: Luke Macken <lmacken@redhat.com>
 
+import os
+import json
+import time
 import logging
 
-import dnf
+from multiprocessing.pool import ThreadPool
+
 import requests
+import rpm
+
+from ..utils import atomic_write, get_cache_dir
 
 
 log = logging.getLogger('moksha.hub')
@@ -33,28 +40,192 @@ else:
     HAS_ABRT = True
 
 
+RPMDB_PATHS = [
+    '/usr/lib/sysimage/rpm/rpmdb.sqlite',
+    '/var/lib/rpm/rpmdb.sqlite',
+    '/var/lib/rpm/Packages',
+]
+
+
+def get_package_databases():
+    """The files that change when packages are installed or removed"""
+    return [path for path in RPMDB_PATHS if os.path.exists(path)]
+
+
 def get_installed_packages():
-    """Retrieve the packages installed on the system"""
-    base = dnf.Base()
-    sack = base.fill_sack(load_system_repo=True)
-    query = sack.query()
-    installed = query.installed()
-    pkgs = installed.run()
-    return (pkg.name for pkg in pkgs)
-
-def get_user_packages(usernames):
+    """Retrieve the packages installed on the system
+
+    The names are read straight from the rpmdb, without loading any repo
+    metadata, and without checking each header's signature.
+    """
+    ts = rpm.TransactionSet()
+    ts.setVSFlags(rpm._RPMVSF_NOSIGNATURES | rpm._RPMVSF_NODIGESTS)
+    try:
+        return set(header[rpm.RPMTAG_NAME] for header in ts.dbMatch())
+    finally:
+        ts.closeDB()
+
+
+# Point this at another Pagure instance, such as a local stub, for testing
+DIST_GIT_URL = os.environ.get('FEDMSG_NOTIFY_DIST_GIT_URL',
+                              'https://src.fedoraproject.org')
+# The dist-git namespaces whose repositories are named after packages
+NAMESPACES = ('rpms', 'modules', 'container')
+# How long we use our cached copies without even revalidating them
+USER_PACKAGES_TTL = 15 * 60
+
+
+def _query_user_packages(session, base_url, username, cached_pages=(),
+                         timeout=30):
+    """Ask dist-git for every repository of a user, one page at a time.
+
+    Each page is requested with the ETag that we got for it last time, and
+    a page that hasn't changed is taken from `cached_pages`. Returns the
+    pages, each with its etag, packages and whether there is a next one.
+    """
+    pages = []
+    url = '{}/api/0/user/{}'.format(base_url.rstrip('/'), username)
+    params = {'per_page': 100, 'repopage': 1}
+    while True:
+        cached = None
+        headers = {}
+        if len(cached_pages) >= params['repopage']:
+            cached = cached_pages[params['repopage'] - 1]
+            if cached.get('etag'):
+                headers['If-None-Match'] = cached['etag']
+        response = session.get(url, params=params, headers=headers,
+                               timeout=timeout)
+        if response.status_code == 304 and cached:
+            page = cached
+        else:
+            response.raise_for_status()
+            data = response.json()
+            pagination = data.get('repos_pagination') or {}
+            page = {
+                'etag': response.headers.get('etag'),
+                'packages': sorted(
+                    repo['name'] for repo in data['repos']
+                    if repo.get('namespace', 'rpms') in NAMESPACES),
+                'next': bool(pagination.get('next')),
+            }
+        pages.append(page)
+        if not page['next']:
+            break
+        params['repopage'] += 1
+    return pages
+
+
+def _pages_packages(pages):
     packages = set()
-    for username in usernames:
+    for page in pages:
+        packages.update(page['packages'])
+    return packages
+
+
+def _user_cache_file(username):
+    return os.path.join(get_cache_dir('dist-git'), username + '.json')
+
+
+def _load_user_packages(username, base_url):
+    try:
+        with open(_user_cache_file(username)) as f:
+            cached = json.load(f)
+    except (IOError, ValueError):
+        return
+    if cached.get('url') == base_url and 'pages' in cached:
+        return cached
+
+
+def _save_user_packages(username, base_url, pages):
+    try:
+        atomic_write(_user_cache_file(username), json.dumps({
+            'url': base_url,
+            'fetched': time.time(),
+            'pages': pages,
+        }))
+    except (IOError, OSError):
+        log.exception("Unable to cache %s's packages" % username)
+
+
+def get_user_packages(usernames, base_url=None, max_age=USER_PACKAGES_TTL,
+                      workers=4):
+    """
+    Retrieve the packages that `usernames` have access to in dist-git.
+
+    Each user's packages are cached on disk, and used as they are for
+    `max_age` seconds. After that, they are revalidated page by page with
+    their ETags. Users that we need to ask about are queried in parallel,
+    over keep-alive connections, and fall back to their cached packages if
+    the query fails.
+    """
+    base_url = base_url or DIST_GIT_URL
+    usernames = [u for u in usernames if u and '/' not in u]
+    if not usernames:
+        return set()
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    def fetch(username):
+        cached = _load_user_packages(username, base_url)
+        if cached and time.time() - cached.get('fetched', 0) < max_age:
+            return _pages_packages(cached['pages'])
         log.info("Querying dist-git for %s's packages" % username)
-        response = requests.get(
-            "https://src.fedoraproject.org/api/0/user/{}".format(username)
-        )
-        pkgs = [repo["name"] for repo in response.json()["repos"]]
-        log.info("Got %s packages to notify about" % len(pkgs))
-        packages.update(pkgs)
+        try:
+            pages = _query_user_packages(session, base_url, username,
+                                         cached and cached['pages'] or ())
+        except (requests.RequestException, ValueError, KeyError) as e:
+            log.warn("Unable to query dist-git for %s: %s" % (username, e))
+            return _pages_packages(cached['pages']) if cached else set()
+        packages = _pages_packages(pages)
+        log.info("Got %s packages to notify about" % len(packages))
+        _save_user_packages(username, base_url, pages)
+        return packages
+
+    pool = ThreadPool(min(workers, len(usernames)))
+    try:
+        results = pool.map(fetch, usernames)
+    finally:
+        pool.close()
+        session.close()
+    packages = set()
+    for result in results:
+        packages.update(result)
     return packages
 
 
+ABRT_SPOOL_DIRS = [
+    '/var/spool/abrt',
+    os.path.expanduser('~/.cache/abrt/spool'),
+]
+
+
+def get_problem_files():
+    """The directories that change when ABRT reports a problem somewhere
+
+    The problem directories in the system spool belong to root, so we can't
+    look inside them, but their own mtimes change when files such as
+    `reported_to` are added to them.
+    """
+    paths = []
+    for spool in ABRT_SPOOL_DIRS:
+        try:
+            problems = os.listdir(spool)
+        except OSError:
+            continue
+        paths.append(spool)
+        paths.extend(os.path.join(spool, p) for p in sorted(problems))
+    return paths
+
+
+def get_problem_count():
+    """How many problems ABRT lets us see, or None without ABRT"""
+    if not HAS_ABRT:
+        return None
+    return len(problem.list())
+
+
 def get_reported_bugs():
     """
     Get bug numbers from local abrt reports
@@ -16,14 +16,24 @@
 # Copyright (C) 2012, 2013 Red Hat, Inc.
 # Authors: Luke Macken <lmacken@redhat.com>
 
+import os
 import json
+import time
 import logging
 
-from twisted.internet import reactor
+from twisted.internet import defer, reactor
 
 from .distro_specific import (get_installed_packages,
+                              get_package_databases,
+                              get_problem_count,
+                              get_problem_files,
                               get_reported_bugs,
                               get_user_packages)
+from .index import extract_bugs
+from .loaders import loaders
+from .metrics import Histogram
+from .snapshots import Snapshot
+from .utils import file_fingerprint
 
 log = logging.getLogger('moksha.hub')
 
@@ -31,62 +41,219 @@ log = logging.getLogger('moksha.hub')
 class Filter(object):
     __description__ = None
     __user_entry__ = None
+    match_attr = None  # The message attribute that our keys are matched on
+    __priority__ = 1  # How important our matches are to display
+
+    __refresh_key__ = None  # The setting of how often to reload our keys
+
+    on_change = None  # Called by the filter when its keys have changed
+    state = 'ready'  # Whether the filter has what it needs to match
 
     def __init__(self, settings):
         self.settings = settings
 
+    def keys(self):
+        """ The values of our `match_attr` attribute that this filter matches """
+        return set()
+
+    def changed(self):
+        if self.on_change:
+            self.on_change(self)
+
     def match(self, msg, processor):
         raise NotImplementedError
 
+    def close(self):
+        """ Called when the filter is disabled """
+
     @classmethod
     def is_available(self):
         return True
 
+    def stats(self):
+        return {'state': self.state, 'keys': len(self.keys())}
+
     def __repr__(self):
         return '<%s>' % self.__class__.__name__
 
 
-class ReportedBugsFilter(Filter):
+class LoadedFilter(Filter):
+    """A filter whose keys take a while to load.
+
+    The keys from the last run are loaded from a snapshot on disk, so we
+    can start matching messages right away. Fresh keys are then loaded in
+    our loader pool, and swapped in all at once when they are ready. Filters that
+    can tell whether their source has changed since the snapshot was taken,
+    through their `fingerprint`, skip loading it again when it hasn't. Keys
+    that turn out to be the same as the ones we have aren't swapped in.
+
+    The `state` is ``loading`` until we have any keys, ``snapshot`` while
+    we are matching with the ones from the last run, ``ready`` once they
+    are fresh, or ``failed`` if we have none and couldn't load them.
+
+    Without `autoload`, nothing is loaded or watched until we are told to
+    `refresh`, which lets the benchmark hand us its own keys.
+    """
+
+    def __init__(self, settings, autoload=True):
+        self.settings = settings
+        self.loading = None
+        self.stale = self.closed = False
+        self.checked = None  # When we last made sure our keys were current
+        self.refreshes = self.unchanged = 0
+        self.refresh_time = Histogram()
+        setattr(self, self.match_attr, set())
+        self.snapshot = Snapshot(self.__class__.__name__, self.source())
+        keys = self.snapshot.load()
+        if keys is None:
+            self.state = 'loading'
+        else:
+            setattr(self, self.match_attr, keys)
+            self.state = 'snapshot'
+        if autoload:
+            self.refresh()
+
+    def source(self):
+        """ What our keys depend on, besides the state of the system """
+        return ''
+
+    def fingerprint(self):
+        """ Something that changes along with our source, or None """
+        return None
+
+    def load(self):
+        """ Load our keys. Called in a thread. """
+        raise NotImplementedError
+
+    def refresh(self):
+        if self.loading:
+            # Load again once this one is done, in case it started before
+            # the change that we're being told about.
+            self.stale = True
+            return self.loading
+        if self.closed:
+            return defer.succeed(None)
+        # Identical filters, such as one that was just disabled and enabled
+        # again, share a single load.
+        key = (self.__class__.__name__, self.source())
+        self.loading = loaders.submit(key, self._load)
+        self.loading.addCallbacks(self._loaded, errback=self._failed)
+        self.loading.addBoth(self._done)
+        return self.loading
+
+    def _load(self):
+        start = time.time()
+        fingerprint = self.fingerprint()
+        if fingerprint is not None and fingerprint == self.snapshot.fingerprint:
+            return None, fingerprint, time.time() - start
+        return set(self.load()), fingerprint, time.time() - start
+
+    def _loaded(self, result):
+        if result is None:
+            return
+        keys, fingerprint, duration = result
+        self.refreshes += 1
+        self.refresh_time.observe(duration)
+        self.checked = time.time()
+        self.state = 'ready'
+        if keys is None or keys == self.keys():
+            log.debug('%r is unchanged' % self)
+            self.unchanged += 1
+            if keys is not None and fingerprint != self.snapshot.fingerprint:
+                self.snapshot.save(keys, fingerprint)
+            return
+        setattr(self, self.match_attr, keys)
+        self.snapshot.save(keys, fingerprint)
+        self.changed()
+
+    def _failed(self, failure):
+        if failure.check(defer.CancelledError):
+            return
+        log.error('Unable to load %r: %s' % (self, failure.getErrorMessage()))
+        if self.state == 'loading':
+            self.state = 'failed'
+
+    def _done(self, result):
+        self.loading = None
+        if self.stale:
+            self.stale = False
+            self.refresh()
+
+    def close(self):
+        self.closed = True
+        if self.loading:
+            self.loading.cancel()
+
+    def keys(self):
+        return getattr(self, self.match_attr)
+
+    def stats(self):
+        stats = Filter.stats(self)
+        stats.update({
+            'snapshot_age': self.snapshot.age,
+            'age': self.checked and time.time() - self.checked,
+            'refreshes': self.refreshes,
+            'unchanged': self.unchanged,
+            'refresh_time': self.refresh_time.stats(),
+        })
+        return stats
+
+
+class ReportedBugsFilter(LoadedFilter):
     """ Matches messages that reference bugs that abrt has encountered """
     __description__ = 'Bugs that you have encountered'
+    match_attr = 'bugs'
+    __priority__ = 2
+    __refresh_key__ = 'reported-bugs-refresh'
 
-    def __init__(self, settings):
+    def fingerprint(self):
+        files = file_fingerprint(get_problem_files())
+        if files:
+            # Problems can also come and go where we can't see them
+            return files + [get_problem_count()]
+
+    def load(self):
         """ Pull bug numbers out of local reports """
-        self.bugs = get_reported_bugs()
+        return get_reported_bugs()
+
+    def keys(self):
+        return self.bugs
 
     def match(self, msg, processor):
         """ Check if this update fixes and of our bugs """
-        if processor.__name__ == 'Bodhi':
-            update = msg['msg'].get('update')
-            if update:
-                bugs = [bug['bug_id'] for bug in update['bugs']]
-                for bug in self.bugs:
-                    if bug in bugs:
-                        log.info("Message contains bug that user filed!")
-                        return True
+        for bug in extract_bugs(msg, processor):
+            if bug in self.bugs:
+                log.info("Message contains bug that user filed!")
+                return True
 
     @classmethod
     def is_available(self):
         return not getattr(get_reported_bugs, 'disabled', False)
 
 
-class MyPackageFilter(Filter):
+class MyPackageFilter(LoadedFilter):
     """ Matches messages regarding packages that a given user has ACLs on """
     __description__ = 'Packages that these users maintain'
     __user_entry__ = 'Usernames'
+    match_attr = 'packages'
+    __refresh_key__ = 'user-packages-refresh'
 
-    def __init__(self, settings):
-        self.usernames = settings.replace(',', ' ').split()
-        self.packages = set()
-        reactor.callInThread(self._query_maintained_packages)
+    def __init__(self, settings, autoload=True):
+        self.usernames = sorted(set(settings.replace(',', ' ').split()))
+        LoadedFilter.__init__(self, settings, autoload)
 
-    def _query_maintained_packages(self):
-        self.packages = get_user_packages(self.usernames)
+    def source(self):
+        return ' '.join(self.usernames)
+
+    def load(self):
+        return get_user_packages(self.usernames)
+
+    def keys(self):
+        return self.packages
 
     def match(self, msg, processor):
-        packages = processor.packages(msg)
-        for package in self.packages:
-            if package in packages:
+        for package in processor.packages(msg):
+            if package in self.packages:
                 return True
 
 
@@ -94,9 +261,14 @@ class UsernameFilter(Filter):
     """ Matches messages that contain specific usernames """
     __description__ = 'Messages that reference specific users'
     __user_entry__ = 'Usernames'
+    match_attr = 'usernames'
+    __priority__ = 2
 
     def __init__(self, settings):
-        self.usernames = settings.replace(',', ' ').split()
+        self.usernames = set(settings.replace(',', ' ').split())
+
+    def keys(self):
+        return self.usernames
 
     def match(self, msg, processor):
         for username in processor.usernames(msg):
@@ -108,9 +280,13 @@ class PackageFilter(Filter):
     """ Matches messages referencing packages that are specified by the user """
     __description__ = 'Messages that reference specific packages'
     __user_entry__ = 'Packages'
+    match_attr = 'packages'
 
     def __init__(self, settings):
-        self.packages = settings.replace(',', ' ').split()
+        self.packages = set(settings.replace(',', ' ').split())
+
+    def keys(self):
+        return self.packages
 
     def match(self, msg, processor):
         for package in processor.packages(msg):
@@ -118,16 +294,68 @@ class PackageFilter(Filter):
                 return True
 
 
-class InstalledPackageFilter(Filter):
-    """ Matches messages referencing packages that are installed locally """
-    __description__ = 'Packages that you have installed'
+class InstalledPackageFilter(LoadedFilter):
+    """Matches messages referencing packages that are installed locally.
 
-    def __init__(self, settings):
-        self.packages = []
-        reactor.callInThread(self._query_local_packages)
-
-    def _query_local_packages(self):
-        self.packages = list(get_installed_packages())
+    We watch the package database for changes, and read it again once a
+    transaction has settled down, so packages are tracked as they are
+    installed and removed without restarting the daemon.
+    """
+    __description__ = 'Packages that you have installed'
+    match_attr = 'packages'
+    settle_time = 5  # Seconds to wait for the package database to be quiet
+
+    def __init__(self, settings, autoload=True):
+        self.monitors = []
+        self.pending = None
+        LoadedFilter.__init__(self, settings, autoload)
+        if autoload:
+            self.watch()
+
+    def watch(self):
+        from gi.repository import Gio
+        databases = set(os.path.basename(path)
+                        for path in get_package_databases())
+        for directory in set(os.path.dirname(path)
+                             for path in get_package_databases()):
+            try:
+                monitor = Gio.File.new_for_path(directory).monitor_directory(
+                    Gio.FileMonitorFlags.NONE, None)
+            except Exception:
+                log.exception('Unable to watch %s for changes' % directory)
+                continue
+            monitor.connect('changed', self._database_changed, databases)
+            self.monitors.append(monitor)
+
+    def _database_changed(self, monitor, changed, other, event, databases):
+        # SQLite and dpkg write alongside the database, in -wal and -new files
+        name = changed.get_basename() or ''
+        if not any(name.startswith(db) for db in databases):
+            return
+        if self.pending is not None and self.pending.active():
+            self.pending.reset(self.settle_time)
+        else:
+            self.pending = reactor.callLater(self.settle_time, self.refresh)
+
+    def fingerprint(self):
+        paths = []
+        for path in get_package_databases():
+            paths.extend([path, path + '-wal'])
+        return file_fingerprint(paths) or None
+
+    def load(self):
+        return get_installed_packages()
+
+    def close(self):
+        LoadedFilter.close(self)
+        for monitor in self.monitors:
+            monitor.cancel()
+        self.monitors = []
+        if self.pending is not None and self.pending.active():
+            self.pending.cancel()
+
+    def keys(self):
+        return self.packages
 
     def match(self, msg, processor):
         for package in processor.packages(msg):
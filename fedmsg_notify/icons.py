@@ -0,0 +1,340 @@
+# This file is a part of fedmsg-notify.
+#
+# fedmsg-notify is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# fedmsg-notify is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with fedmsg-notify.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import time
+import hashlib
+import logging
+import tempfile
+
+from collections import OrderedDict
+from urlparse import urlparse
+
+from twisted.internet import defer, protocol, reactor
+from twisted.web.client import (Agent, HTTPConnectionPool, RedirectAgent,
+                                ResponseDone)
+from twisted.web.http import PotentialDataLoss
+from twisted.web.http_headers import Headers
+
+from .metrics import Histogram
+from .utils import atomic_write
+
+log = logging.getLogger('moksha.hub')
+
+
+class IconCache(object):
+    """A persistent, size-bounded store of downloaded icons.
+
+    Icons are stored once per unique content, named after the SHA-1 of their
+    data, so the many avatar URLs that resolve to the same image share a
+    single file. The index of URLs, along with the HTTP validators that the
+    server gave us for them, is kept in least-recently-used order and saved
+    to disk, so icons survive daemon restarts. Once the blobs grow past
+    `max_size` bytes, the least recently used URLs are evicted.
+
+    The index is saved at most once every `save_delay` seconds, rather than
+    after every download. Blobs that are pinned, because a notification is
+    about to show them, are only deleted once they are unpinned.
+    """
+    index_name = 'index.json'
+    save_delay = 10
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.blob_dir = os.path.join(path, 'blobs')
+        if not os.path.isdir(self.blob_dir):
+            os.makedirs(self.blob_dir)
+        self.max_size = max_size
+        self.entries = OrderedDict()  # {url: entry}, oldest first
+        self.blobs = {}  # {digest: [size, number of urls using it]}
+        self.size = 0
+        self.validated = set()  # URLs that we have checked this session
+        self.pinned = {}  # {digest: number of pins}
+        self.save_call = None
+        self.load()
+
+    @property
+    def index_file(self):
+        return os.path.join(self.path, self.index_name)
+
+    def blob_path(self, digest):
+        return os.path.join(self.blob_dir, digest)
+
+    def load(self):
+        try:
+            with open(self.index_file) as f:
+                entries = json.load(f)['entries']
+        except (IOError, ValueError, KeyError):
+            return
+        for url, entry in entries:
+            if os.path.exists(self.blob_path(entry['blob'])):
+                self._add_entry(url, entry)
+        # Clean up any blobs that a previous run didn't get to index
+        for digest in os.listdir(self.blob_dir):
+            if digest not in self.blobs:
+                os.unlink(self.blob_path(digest))
+        log.debug('Loaded %d cached icons (%d bytes)' % (
+            len(self.entries), self.size))
+
+    def save_later(self):
+        if self.save_call is None or not self.save_call.active():
+            self.save_call = reactor.callLater(self.save_delay, self.save)
+
+    def save(self):
+        if self.save_call is not None and self.save_call.active():
+            self.save_call.cancel()
+        self.save_call = None
+        data = json.dumps({'entries': list(self.entries.items())})
+        try:
+            atomic_write(self.index_file, data)
+        except (IOError, OSError):
+            log.exception('Unable to save the icon cache index')
+
+    def get(self, url):
+        """ Return the filename of a cached icon, or None """
+        entry = self.entries.pop(url, None)
+        if entry is None:
+            return
+        self.entries[url] = entry
+        return self.blob_path(entry['blob'])
+
+    def pin(self, url):
+        """ Keep a cached icon's blob on disk, returning its digest or None """
+        entry = self.entries.get(url)
+        if entry is None:
+            return
+        digest = entry['blob']
+        self.pinned[digest] = self.pinned.get(digest, 0) + 1
+        return digest
+
+    def unpin(self, digests):
+        for digest in digests:
+            pins = self.pinned.pop(digest) - 1
+            if pins:
+                self.pinned[digest] = pins
+            elif digest not in self.blobs:
+                # It was evicted while it was pinned
+                self._unlink(digest)
+
+    def is_fresh(self, url):
+        """ Whether we can use this icon without asking the server again """
+        return url in self.validated and url in self.entries
+
+    def headers(self, url):
+        """ The conditional request headers to revalidate a cached icon """
+        headers = {}
+        entry = self.entries.get(url)
+        if entry:
+            if entry.get('etag'):
+                headers['If-None-Match'] = [entry['etag']]
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = [entry['last_modified']]
+        return headers
+
+    def revalidated(self, url):
+        """ The server told us that our copy of this icon is still good """
+        self.validated.add(url)
+        return self.get(url)
+
+    def add(self, url, filename, digest, etag=None, last_modified=None):
+        """ Move a freshly downloaded icon into the store """
+        if url in self.entries:
+            self._remove_entry(url)
+        size = os.path.getsize(filename)
+        blob = self.blob_path(digest)
+        if digest in self.blobs:
+            os.unlink(filename)
+        else:
+            os.rename(filename, blob)
+        self._add_entry(url, {
+            'blob': digest,
+            'size': size,
+            'etag': etag,
+            'last_modified': last_modified,
+        })
+        self.validated.add(url)
+        self.evict()
+        self.save_later()
+        return blob
+
+    def evict(self):
+        while self.size > self.max_size and len(self.entries) > 1:
+            url = next(iter(self.entries))
+            log.debug('Evicting icon %s' % url)
+            self._remove_entry(url)
+
+    def _add_entry(self, url, entry):
+        self.entries[url] = entry
+        blob = self.blobs.setdefault(entry['blob'], [entry['size'], 0])
+        if not blob[1]:
+            self.size += blob[0]
+        blob[1] += 1
+
+    def _remove_entry(self, url):
+        entry = self.entries.pop(url)
+        self.validated.discard(url)
+        blob = self.blobs[entry['blob']]
+        blob[1] -= 1
+        if not blob[1]:
+            del self.blobs[entry['blob']]
+            self.size -= blob[0]
+            if entry['blob'] not in self.pinned:
+                self._unlink(entry['blob'])
+
+    def _unlink(self, digest):
+        try:
+            os.unlink(self.blob_path(digest))
+        except OSError:
+            pass
+
+
+class BlobReceiver(protocol.Protocol):
+    """ Writes a response body to a file, hashing it as it arrives """
+
+    def __init__(self, f):
+        self.f = f
+        self.hash = hashlib.sha1()
+        self.finished = defer.Deferred(self._cancel)
+
+    def _cancel(self, d):
+        if self.transport:
+            self.transport.stopProducing()
+
+    def dataReceived(self, data):
+        self.f.write(data)
+        self.hash.update(data)
+
+    def connectionLost(self, reason):
+        self.f.close()
+        if self.finished.called:
+            return
+        if reason.check(ResponseDone, PotentialDataLoss):
+            self.finished.callback(self.hash.hexdigest())
+        else:
+            self.finished.errback(reason)
+
+
+class IconFetcher(object):
+    """Downloads icons into an :class:`IconCache`, revalidating old ones.
+
+    A burst of messages from the same user all want the same avatar at once,
+    so concurrent requests for a URL share a single download. Downloads go
+    through a pool of persistent connections, with at most `max_per_host`
+    of them running against any one server.
+    """
+
+    def __init__(self, cache, max_per_host=2, timeout=30):
+        self.cache = cache
+        self.timeout = timeout
+        self.max_per_host = max_per_host
+        self.pool = HTTPConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = max_per_host
+        self.agent = RedirectAgent(Agent(reactor, connectTimeout=timeout,
+                                         pool=self.pool))
+        self.pending = {}  # {url: [Deferreds waiting on its download]}
+        self.hosts = {}  # {host: DeferredSemaphore}
+        self.hits = self.downloads = self.coalesced = 0
+        self.revalidated = self.failures = 0
+        self.latency = Histogram()  # How long downloads take
+
+    def fetch(self, url):
+        """ Return a Deferred that fires with the icon's filename, or None """
+        if self.cache.is_fresh(url):
+            self.hits += 1
+            return defer.succeed(self.cache.get(url))
+        d = defer.Deferred()
+        waiting = self.pending.get(url)
+        if waiting is not None:
+            self.coalesced += 1
+            waiting.append(d)
+            return d
+        self.pending[url] = [d]
+        host = urlparse(url).netloc
+        semaphore = self.hosts.get(host)
+        if semaphore is None:
+            semaphore = self.hosts[host] = defer.DeferredSemaphore(
+                self.max_per_host)
+        download = semaphore.run(self._download, url)
+        download.addBoth(self._finished, url)
+        return d
+
+    def _finished(self, filename, url):
+        for d in self.pending.pop(url):
+            d.callback(filename)
+
+    def _download(self, url):
+        log.debug('Downloading icon: %s' % url)
+        self.downloads += 1
+        d = self.agent.request('GET', str(url),
+                               Headers(self.cache.headers(url)))
+        d.addCallback(self._got_response, url)
+        d.addTimeout(self.timeout, reactor)
+        d.addErrback(self._failed, url)
+        d.addBoth(self._downloaded, time.time())
+        return d
+
+    def _downloaded(self, result, start):
+        self.latency.observe(time.time() - start)
+        return result
+
+    def _got_response(self, response, url):
+        if response.code == 304:
+            self.revalidated += 1
+            response.deliverBody(protocol.Protocol())
+            return self.cache.revalidated(url)
+        if response.code != 200:
+            self.failures += 1
+            log.debug('Failed to download %s: %s' % (url, response.code))
+            response.deliverBody(protocol.Protocol())
+            return self.cache.get(url)
+        fd, filename = tempfile.mkstemp(dir=self.cache.path, prefix='.icon-')
+        receiver = BlobReceiver(os.fdopen(fd, 'wb'))
+        response.deliverBody(receiver)
+        headers = response.headers
+        etag = headers.getRawHeaders('etag', [None])[0]
+        last_modified = headers.getRawHeaders('last-modified', [None])[0]
+
+        def store(digest):
+            return self.cache.add(url, filename, digest, etag, last_modified)
+
+        def cleanup(failure):
+            if os.path.exists(filename):
+                os.unlink(filename)
+            return failure
+
+        receiver.finished.addCallbacks(store, cleanup)
+        return receiver.finished
+
+    def _failed(self, failure, url):
+        self.failures += 1
+        log.debug('Failed to download %s: %s' % (url,
+                                                  failure.getErrorMessage()))
+        return self.cache.get(url)
+
+    def stats(self):
+        return {
+            'cached': len(self.cache.entries),
+            'cache_bytes': self.cache.size,
+            'hits': self.hits,
+            'downloads': self.downloads,
+            'coalesced': self.coalesced,
+            'revalidated': self.revalidated,
+            'failures': self.failures,
+            'download_latency': self.latency.stats(),
+        }
+
+    def close(self):
+        return self.pool.closeCachedConnections()
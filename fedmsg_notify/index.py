@@ -0,0 +1,156 @@
+# This file is a part of fedmsg-notify.
+#
+# fedmsg-notify is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# fedmsg-notify is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with fedmsg-notify.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+
+log = logging.getLogger('moksha.hub')
+
+
+def extract_packages(msg, processor):
+    return processor.packages(msg)
+
+
+def extract_usernames(msg, processor):
+    return processor.usernames(msg)
+
+
+def extract_bugs(msg, processor):
+    """ Pull the bug numbers out of Bodhi updates """
+    if processor.__name__ == 'Bodhi':
+        update = msg['msg'].get('update')
+        if update:
+            return [bug['bug_id'] for bug in update['bugs']]
+    return []
+
+
+# The message attributes that filters can be indexed on, in the order that
+# they are extracted from each message.
+extractors = [
+    ('bugs', extract_bugs),
+    ('packages', extract_packages),
+    ('usernames', extract_usernames),
+]
+
+
+class MatchIndex(object):
+    """An inverted index of every key that our enabled filters care about.
+
+    Each filter declares which message attribute it matches on with its
+    ``match_attr`` attribute, and the values it matches with its ``keys()``
+    method. We map each of those values back to the filters that want them,
+    so matching a message only costs one dictionary lookup per value that we
+    extract from it, regardless of how many packages are installed.
+
+    Filters that do not declare a ``match_attr`` fall back to their own
+    ``match`` method.
+
+    The index is copy-on-write: changes build new tables and swap them in
+    all at once, so ``match`` can be called from other threads without any
+    locking, and always sees a consistent `view`.
+    """
+
+    def __init__(self):
+        self.filters = ()    # Every filter, in the order they were enabled
+        self.unindexed = ()  # Filters that we have to call `match` on
+        self.tables = dict((attr, {}) for attr, _ in extractors)
+        self._keys = {}      # {filter: keys currently in the index}
+        self.view = (self.filters, self.unindexed, self.tables)
+
+    def add(self, filter):
+        filters, unindexed, tables = self.view
+        filters += (filter,)
+        if filter.match_attr is None:
+            unindexed += (filter,)
+        else:
+            keys = frozenset(filter.keys())
+            tables = self._update(tables, filter, keys, ())
+            self._keys[filter] = keys
+            log.debug('Indexed %d %s for %r' % (len(keys), filter.match_attr,
+                                                  filter))
+        self._publish(filters, unindexed, tables)
+        filter.on_change = self.refresh
+
+    def remove(self, filter):
+        filter.on_change = None
+        filters, unindexed, tables = self.view
+        filters = tuple(f for f in filters if f is not filter)
+        if filter in unindexed:
+            unindexed = tuple(f for f in unindexed if f is not filter)
+        else:
+            keys = self._keys.pop(filter, ())
+            tables = self._update(tables, filter, (), keys)
+        self._publish(filters, unindexed, tables)
+
+    def refresh(self, filter):
+        """Update a filter's entries after its data set has changed.
+
+        Only the keys that were added or removed since we last indexed the
+        filter are touched, so small changes to big data sets are cheap.
+        """
+        if filter not in self.filters or filter.match_attr is None:
+            return
+        old = self._keys.get(filter, frozenset())
+        new = frozenset(filter.keys())
+        tables = self._update(self.tables, filter, new - old, old - new)
+        self._keys[filter] = new
+        self._publish(self.filters, self.unindexed, tables)
+        log.debug('Updated %r: %d %s added, %d removed' % (
+            filter, len(new - old), filter.match_attr, len(old - new)))
+
+    def _update(self, tables, filter, added, removed):
+        """ A copy of the tables, with this filter's keys changed """
+        table = dict(tables[filter.match_attr])
+        just_filter = frozenset([filter])
+        for key in added:
+            table[key] = table.get(key, frozenset()) | just_filter
+        for key in removed:
+            matching = table.get(key, frozenset()) - just_filter
+            if matching:
+                table[key] = matching
+            else:
+                table.pop(key, None)
+        tables = dict(tables)
+        tables[filter.match_attr] = table
+        return tables
+
+    def _publish(self, filters, unindexed, tables):
+        self.filters, self.unindexed, self.tables = filters, unindexed, tables
+        self.view = (filters, unindexed, tables)
+
+    def match(self, msg, processor):
+        """ Return the filter that matches this message, or None.
+
+        When more than one filter matches, the one with the highest
+        priority gets the credit, and then the one that was enabled first.
+        """
+        filters, unindexed, tables = self.view
+        matched = set()
+        for attr, extract in extractors:
+            table = tables[attr]
+            if not table:
+                continue
+            for value in extract(msg, processor):
+                matching = table.get(value)
+                if matching:
+                    matched.update(matching)
+        if matched:
+            return max(matched, key=lambda f: (f.__priority__,
+                                               -filters.index(f)))
+        for filter in unindexed:
+            if filter.match(msg, processor):
+                return filter
+
+    def __len__(self):
+        return len(self.filters)
@@ -0,0 +1,122 @@
+# This file is a part of fedmsg-notify.
+#
+# fedmsg-notify is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# fedmsg-notify is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with fedmsg-notify.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import threading
+
+from twisted.internet import defer, reactor, threads
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
+
+log = logging.getLogger('moksha.hub')
+
+
+class Load(object):
+    """ One run of a loader, and everyone waiting for its result """
+
+    def __init__(self, key):
+        self.key = key
+        self.waiting = []  # [Deferred]
+        self.started = self.cancelled = False
+
+
+class LoaderPool(object):
+    """The threads that our filters load their data sets in.
+
+    Loaders get their own small pool, rather than Twisted's shared one, so
+    a few slow package database reads and HTTP queries can't hold up icon
+    downloads or anything else running in threads. Loads with the same key
+    that are requested while one is pending share its result. A load whose
+    callers have all cancelled, such as when its filter is disabled, is
+    skipped if it hasn't started yet. One that has started stays pending
+    until it finishes, so that a filter enabled again in the meantime picks
+    up its result instead of starting another. Results are always delivered
+    on the reactor thread.
+    """
+
+    def __init__(self, size=2):
+        self.pool = ThreadPool(minthreads=0, maxthreads=size,
+                               name='fedmsg-notify-loaders')
+        self.pending = {}  # {key: Load}
+        self.lock = threading.Lock()  # Held while starting or cancelling
+        self.runs = self.shared = self.cancelled = 0
+
+    def start(self):
+        if not self.pool.started:
+            self.pool.start()
+            reactor.addSystemEventTrigger('during', 'shutdown', self.stop)
+
+    def stop(self):
+        if self.pool.started:
+            self.pool.stop()
+
+    def submit(self, key, func, *args, **kw):
+        """ Run a loader in our pool, returning a Deferred of its result """
+        load = self.pending.get(key)
+        if load is None:
+            load = self.pending[key] = Load(key)
+            self.runs += 1
+            self.start()
+            d = threads.deferToThreadPool(reactor, self.pool, self._run,
+                                          load, func, *args, **kw)
+            d.addBoth(self._finished, load)
+        else:
+            self.shared += 1
+        waiter = defer.Deferred(lambda d: self._cancel(d, load))
+        load.waiting.append(waiter)
+        return waiter
+
+    def _run(self, load, func, *args, **kw):
+        with self.lock:
+            if load.cancelled:
+                return
+            load.started = True
+        return func(*args, **kw)
+
+    def _cancel(self, waiter, load):
+        if waiter in load.waiting:
+            load.waiting.remove(waiter)
+        if load.waiting:
+            return
+        with self.lock:
+            if load.started or load.cancelled:
+                # Anyone asking for it again can still use its result
+                return
+            load.cancelled = True
+        log.debug('Cancelled load of %r' % (load.key,))
+        self.cancelled += 1
+        if self.pending.get(load.key) is load:
+            del self.pending[load.key]
+
+    def _finished(self, result, load):
+        if self.pending.get(load.key) is load:
+            del self.pending[load.key]
+        for waiter in load.waiting:
+            if isinstance(result, Failure):
+                waiter.errback(result)
+            else:
+                waiter.callback(result)
+        load.waiting = []
+
+    def stats(self):
+        return {
+            'pending': len(self.pending),
+            'runs': self.runs,
+            'shared': self.shared,
+            'cancelled': self.cancelled,
+        }
+
+
+loaders = LoaderPool()
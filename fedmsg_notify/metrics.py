@@ -0,0 +1,72 @@
+# This file is a part of fedmsg-notify.
+#
+# fedmsg-notify is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# fedmsg-notify is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with fedmsg-notify.  If not, see <http://www.gnu.org/licenses/>.
+
+import bisect
+
+# Bucket bounds, in seconds, for the latencies that we keep track of
+latency_buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30)
+
+
+class Histogram(object):
+    """Counts of observed values, in fixed buckets.
+
+    Observing a value is a bisect and a couple of additions, so histograms
+    can be kept up to date on hot paths and only summed up when read.
+    """
+    __slots__ = ('bounds', 'counts', 'count', 'total')
+
+    def __init__(self, bounds=latency_buckets):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def stats(self):
+        """ The number of values that were at most each bound """
+        buckets, seen = {}, 0
+        for bound, count in zip(self.bounds + ('inf',), self.counts):
+            seen += count
+            buckets['le_%s' % bound] = seen
+        return {'count': self.count, 'sum': self.total, 'buckets': buckets}
+
+
+def flatten(stats, prefix=''):
+    """Turn nested stats into a flat {'a.b.c': value} dict.
+
+    Lists are joined into strings and missing values are left out, so that
+    every value can be sent over DBus as a variant.
+    """
+    flat = {}
+    for key, value in stats.items():
+        key = prefix + str(key)
+        if isinstance(value, dict):
+            flat.update(flatten(value, key + '.'))
+        elif isinstance(value, (list, tuple, set, frozenset)):
+            flat[key] = ','.join(str(v) for v in value)
+        elif isinstance(value, bool):
+            flat[key] = value
+        elif isinstance(value, (int, long)):
+            flat[key] = long(value)
+        elif isinstance(value, float):
+            flat[key] = value
+        elif value is not None:
+            flat[key] = unicode(value)
+    return flat
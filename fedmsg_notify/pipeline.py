@@ -0,0 +1,114 @@
+# This file is a part of fedmsg-notify.
+#
+# fedmsg-notify is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# fedmsg-notify is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with fedmsg-notify.  If not, see <http://www.gnu.org/licenses/>.
+
+import Queue
+import logging
+import threading
+
+log = logging.getLogger('moksha.hub')
+
+
+class Pipeline(object):
+    """Handles messages in worker threads, off the main loop.
+
+    Each worker has its own queue, or lane, and every message on a topic
+    goes down the same lane, so messages on a topic are always handled in
+    the order they arrived. When a lane is full, ``block`` makes the main
+    loop wait for room, which leaves ZeroMQ to hold on to new messages
+    until we catch up. ``drop-oldest`` throws away the message that has
+    been waiting longest, and ``drop-newest`` the one that just arrived.
+    """
+    policies = ('block', 'drop-oldest', 'drop-newest')
+
+    def __init__(self, handler, workers=1, size=500, policy='drop-oldest'):
+        if policy not in self.policies:
+            log.warn('Unknown overflow policy %r, using drop-oldest' % policy)
+            policy = 'drop-oldest'
+        self.handler = handler
+        self.policy = policy
+        self.size = size
+        self.lanes = [Queue.Queue(size) for i in range(max(workers, 1))]
+        self.threads = []
+        self.handled = [0] * len(self.lanes)  # Counted by each worker
+        self.errors = [0] * len(self.lanes)
+        self.queued = self.dropped = self.max_depth = 0
+
+    def start(self):
+        for i, lane in enumerate(self.lanes):
+            thread = threading.Thread(target=self._work, args=(i, lane),
+                                      name='fedmsg-notify-pipeline-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        for lane in self.lanes:
+            # Whatever is still waiting won't get shown anyway
+            while True:
+                try:
+                    lane.get_nowait()
+                except Queue.Empty:
+                    break
+            lane.put(StopIteration)
+        for thread in self.threads:
+            thread.join(1)
+        self.threads = []
+
+    def put(self, topic, message):
+        """ Queue a message, returning False if it was dropped instead """
+        lane = self.lanes[hash(topic) % len(self.lanes)]
+        if self.policy == 'block':
+            lane.put(message)
+        else:
+            try:
+                lane.put_nowait(message)
+            except Queue.Full:
+                self.dropped += 1
+                if self.policy == 'drop-newest':
+                    return False
+                try:
+                    lane.get_nowait()
+                except Queue.Empty:
+                    pass
+                # Only the main loop puts messages in a lane, so there is
+                # room for this one now.
+                lane.put_nowait(message)
+        self.queued += 1
+        self.max_depth = max(self.max_depth, lane.qsize())
+        return True
+
+    def _work(self, i, lane):
+        while True:
+            message = lane.get()
+            if message is StopIteration:
+                break
+            try:
+                self.handler(message)
+            except Exception:
+                log.exception('Unable to handle message')
+                self.errors[i] += 1
+            self.handled[i] += 1
+
+    def stats(self):
+        return {
+            'workers': len(self.lanes),
+            'policy': self.policy,
+            'queued': self.queued,
+            'handled': sum(self.handled),
+            'errors': sum(self.errors),
+            'dropped': self.dropped,
+            'depth': sum(lane.qsize() for lane in self.lanes),
+            'max_depth': self.max_depth,
+        }
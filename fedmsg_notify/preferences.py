@@ -0,0 +1,330 @@
+# This file is a part of fedmsg-notify.
+#
+# fedmsg-notify is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# fedmsg-notify is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with fedmsg-notify.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2012, 2013 Red Hat, Inc.
+# Authors: Luke Macken <lmacken@redhat.com>
+
+import json
+import time
+import logging
+import threading
+
+import fedmsg.utils
+import requests
+
+from twisted.internet import threads
+
+from .metrics import Histogram
+from .utils import atomic_write
+
+log = logging.getLogger('moksha.hub')
+
+
+def repopulate_functions(preference):
+    for fltr in preference['filters']:
+        for rule in fltr['rules']:
+            code_path = str(rule['code_path'])
+            rule['fn'] = fedmsg.utils.load_class(code_path)
+
+    return preference
+
+
+class CompiledRule(object):
+    """ A single FMN rule, along with what we've learned about its cost """
+    __slots__ = ('key', 'fn', 'arguments', 'negated', 'topics',
+                 'categories', 'calls', 'elapsed')
+
+    def __init__(self, rule):
+        self.fn = rule['fn']
+        self.arguments = rule.get('arguments') or {}
+        self.negated = rule.get('negated', False)
+        self.key = rule.get('cache_key') or '%s:%s:%s' % (
+            rule['code_path'], json.dumps(self.arguments, sort_keys=True),
+            self.negated)
+        self.topics = self.categories = None
+        self.calls = self.elapsed = 0
+
+        # Rules advertise the topics they can match through their fmn hints.
+        # We can only trust them when the hint is static and not inverted.
+        hints = getattr(self.fn, 'hints', None) or {}
+        if not self.negated and not getattr(self.fn, 'hinting_callable', None):
+            if hints.get('topics'):
+                self.topics = frozenset(hints['topics'])
+            if hints.get('categories'):
+                self.categories = frozenset(hints['categories'])
+
+    @property
+    def cost(self):
+        if not self.calls:
+            # Rules with topic hints are cheap, untried ones go last
+            return 0 if self.topics or self.categories else float('inf')
+        return self.elapsed / self.calls
+
+    def __call__(self, config, msg):
+        # These counters only guide the order that rules are run in, so we
+        # don't mind losing the odd call to a race between threads.
+        start = time.time()
+        try:
+            value = self.fn(config, msg, **self.arguments)
+        finally:
+            self.calls += 1
+            self.elapsed += time.time() - start
+        if self.negated:
+            value = not value
+        return bool(value)
+
+
+class EvaluationPlan(object):
+    """Our FMN preferences, compiled for matching messages quickly.
+
+    ``fmn.lib.recipients`` runs every rule of every filter on each message.
+    Here, each filter is grouped by the topics (or topic categories) that its
+    rules allow, so filters that can't possibly match a message are skipped
+    without running any of their rules. A filter only matches if all of its
+    rules do, so we are free to run the cheapest rules first, and we remember
+    each rule's result for the current message, for filters sharing rules.
+
+    Matching doesn't change the plan, apart from its counters, so messages
+    can be matched against it from several threads at once. Re-sorting the
+    rules swaps in new lists rather than sorting them in place.
+    """
+    reorder_interval = 256  # Re-sort the rules by cost every N messages
+
+    def __init__(self, preferences):
+        self.preferences = preferences
+        self.filters = []  # [(filter name, [CompiledRule])]
+        self.by_topic = {}  # {topic: [filter index]}
+        self.by_category = {}  # {category: [filter index]}
+        self.unconstrained = []  # Filters that may match any topic
+        self.messages = self.evaluated = self.skipped = self.memo_hits = 0
+        self.lock = threading.Lock()  # Held while updating our counters
+
+        rules = {}
+        for preference in preferences:
+            if not preference.get('detail_values'):
+                # fmn.lib.recipients has nobody to notify for these
+                continue
+            for fltr in preference['filters']:
+                if not fltr['rules']:
+                    continue
+                compiled = []
+                for rule in fltr['rules']:
+                    rule = CompiledRule(rule)
+                    compiled.append(rules.setdefault(rule.key, rule))
+                compiled.sort(key=lambda rule: rule.cost)
+                self._add_filter(fltr['name'], compiled)
+
+    def _add_filter(self, name, rules):
+        i = len(self.filters)
+        self.filters.append((name, rules))
+        topics = categories = None
+        for rule in rules:
+            if rule.topics is not None:
+                topics = rule.topics if topics is None else topics & rule.topics
+            if rule.categories is not None:
+                categories = (rule.categories if categories is None
+                              else categories & rule.categories)
+        if topics is not None:
+            for topic in topics:
+                self.by_topic.setdefault(topic, []).append(i)
+        elif categories is not None:
+            for category in categories:
+                self.by_category.setdefault(category, []).append(i)
+        else:
+            self.unconstrained.append(i)
+
+    def candidates(self, topic):
+        """ The indices of the filters that could match this topic """
+        parts = topic.split('.')
+        category = parts[3] if len(parts) > 3 else None
+        found = (self.by_topic.get(topic, []) +
+                 self.by_category.get(category, []) +
+                 self.unconstrained)
+        return sorted(found)
+
+    def match(self, msg, config):
+        """ Return the name of the first filter that matches, or None """
+        filters = self.filters
+        candidates = self.candidates(msg['topic'])
+        results = {}  # {rule key: result} for this message
+        evaluated = memo_hits = 0
+        matched = None
+        for i in candidates:
+            name, rules = filters[i]
+            evaluated += 1
+            for rule in rules:
+                value = results.get(rule.key)
+                if value is None:
+                    try:
+                        value = results[rule.key] = rule(config, msg)
+                    except Exception:
+                        # A rule that throws an exception does not match
+                        log.exception('Error in rule %s' % rule.key)
+                        break
+                else:
+                    memo_hits += 1
+                if not value:
+                    break
+            else:
+                matched = name
+                break
+        with self.lock:
+            self.messages += 1
+            self.evaluated += evaluated
+            self.skipped += len(filters) - len(candidates)
+            self.memo_hits += memo_hits
+            reorder = not self.messages % self.reorder_interval
+        if reorder:
+            self.reorder()
+        return matched
+
+    def reorder(self):
+        self.filters = [(name, sorted(rules, key=lambda rule: rule.cost))
+                        for name, rules in self.filters]
+
+    def stats(self):
+        return {
+            'filters': len(self.filters),
+            'messages': self.messages,
+            'evaluated': self.evaluated,
+            'skipped': self.skipped,
+            'memo_hits': self.memo_hits,
+        }
+
+
+class PreferenceLoader(object):
+    """Keeps a snapshot of our preferences from the FMN server.
+
+    The last copy that we successfully downloaded is saved to disk, so we can
+    start matching messages with it as soon as the daemon starts. Reloads are
+    done in a thread with a conditional request, and the new preferences are
+    swapped in all at once when they are ready, so messages keep being
+    matched against the previous snapshot in the meantime.
+    """
+
+    def __init__(self, url, filename, timeout=30):
+        self.url = url
+        self.filename = filename
+        self.timeout = timeout
+        self.plan = EvaluationPlan([])
+        self.etag = self.last_modified = None
+        self.loading = None
+        self.stale = False
+        self.loads = self.not_modified = self.failures = 0
+        self.last_duration = self.loaded_at = None
+        self.reload_time = Histogram()
+        self.load_cached()
+
+    def load_cached(self):
+        try:
+            with open(self.filename) as f:
+                cached = json.load(f)
+            preference = repopulate_functions(json.loads(cached['body']))
+        except (IOError, ValueError, KeyError, TypeError):
+            return
+        except Exception:
+            log.exception('Unable to load cached preferences')
+            return
+        if cached.get('url') != self.url:
+            return
+        self.etag = cached.get('etag')
+        self.last_modified = cached.get('last_modified')
+        self.plan = EvaluationPlan([preference])
+        log.info('Loaded cached preferences from %s' % self.filename)
+
+    def reload(self):
+        """ Fetch our preferences in the background """
+        if self.loading:
+            # Fetch again once this one is done, in case it started before
+            # the change that we're being told about.
+            self.stale = True
+            return self.loading
+        log.info("Getting preferences from %s" % self.url)
+        start = time.time()
+        self.loading = threads.deferToThread(self._fetch)
+        self.loading.addCallbacks(self._loaded, errback=self._failed,
+                                  callbackArgs=(start,))
+        self.loading.addBoth(self._done)
+        return self.loading
+
+    def _fetch(self):
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        response = requests.get(self.url, headers=headers,
+                                timeout=self.timeout)
+        if response.status_code == 304 or not response:
+            return response, None
+        preference = repopulate_functions(response.json())
+        return response, EvaluationPlan([preference])
+
+    def _loaded(self, result, start):
+        response, plan = result
+        self.last_duration = time.time() - start
+        self.reload_time.observe(self.last_duration)
+        if response.status_code == 304:
+            log.debug('Preferences not modified')
+            self.not_modified += 1
+            self.loaded_at = time.time()
+            return
+        if plan is None:
+            log.warning("Failed with %r" % response)
+            self.failures += 1
+            return
+        self.plan = plan
+        self.loads += 1
+        self.loaded_at = time.time()
+        self.etag = response.headers.get('etag')
+        self.last_modified = response.headers.get('last-modified')
+        log.info('Loaded preferences in %0.2fs' % self.last_duration)
+        self.save(response.text)
+
+    def _failed(self, failure):
+        self.failures += 1
+        log.warning('Unable to get preferences: %s' %
+                    failure.getErrorMessage())
+
+    def _done(self, result):
+        self.loading = None
+        if self.stale:
+            self.stale = False
+            self.reload()
+
+    def save(self, body):
+        try:
+            atomic_write(self.filename, json.dumps({
+                'url': self.url,
+                'etag': self.etag,
+                'last_modified': self.last_modified,
+                'body': body,
+            }))
+        except (IOError, OSError):
+            log.exception('Unable to save preferences')
+
+    @property
+    def preferences(self):
+        return self.plan.preferences
+
+    def stats(self):
+        return {
+            'loads': self.loads,
+            'not_modified': self.not_modified,
+            'failures': self.failures,
+            'last_duration': self.last_duration,
+            'age': self.loaded_at and time.time() - self.loaded_at,
+            'reload_time': self.reload_time.stats(),
+        }
@@ -0,0 +1,173 @@
+# This file is a part of fedmsg-notify.
+#
+# fedmsg-notify is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# fedmsg-notify is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with fedmsg-notify.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import logging
+import threading
+
+from collections import defaultdict
+
+from twisted.internet import reactor
+
+try:
+    import tracemalloc
+except ImportError:
+    # Only Python 3, or a patched Python 2, can trace allocations
+    tracemalloc = None
+
+log = logging.getLogger('moksha.hub')
+
+
+def collapse(frame):
+    """ A frame's stack, outermost first, in the collapsed-stack format """
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append('%s (%s:%d)' % (code.co_name,
+                                     os.path.basename(code.co_filename),
+                                     code.co_firstlineno))
+        frame = frame.f_back
+    stack.reverse()
+    return ';'.join(stack)
+
+
+class StackSampler(object):
+    """Periodically samples the stack of every thread.
+
+    Unlike cProfile, this sees Moksha's worker threads as well as the main
+    loop, and it only costs the daemon a few hundred stack walks a second.
+    The samples are written in the collapsed-stack format that
+    flamegraph.pl and speedscope read.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.counts = defaultdict(int)  # {collapsed stack: samples}
+        self.samples = 0
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self._run,
+                                       name='fedmsg-notify-sampler')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        me = threading.current_thread().ident
+        while not self.stopping.wait(self.interval):
+            names = dict((t.ident, t.name) for t in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                thread = names.get(ident, str(ident)).replace(' ', '_')
+                self.counts['%s;%s' % (thread, collapse(frame))] += 1
+            self.samples += 1
+
+    def dump(self, filename):
+        with open(filename, 'w') as f:
+            for stack, count in sorted(self.counts.items()):
+                f.write('%s %d\n' % (stack, count))
+
+
+class Profiler(object):
+    """Profiles the live daemon for a while, on request.
+
+    In ``sampling`` mode, every thread's stack is sampled and dumped as
+    collapsed stacks. In ``cprofile`` mode, the main loop is profiled with
+    cProfile and dumped as pstats. When allocations can be traced, they are
+    traced for the same window, and a tracemalloc snapshot is dumped next
+    to the profile.
+    """
+    modes = ('sampling', 'cprofile')
+
+    def __init__(self, mode='sampling'):
+        if mode not in self.modes:
+            log.warn('Unknown profile mode %r, using sampling' % mode)
+            mode = 'sampling'
+        self.mode = mode
+        self.profile = self.call = self.snapshot = None
+
+    @property
+    def running(self):
+        return self.call is not None
+
+    def start(self, seconds):
+        if self.running:
+            return False
+        log.info('Profiling for %d seconds' % seconds)
+        if self.mode == 'cprofile':
+            import cProfile
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        else:
+            self.profile = StackSampler()
+            self.profile.start()
+        self.snapshot = None
+        if tracemalloc and not tracemalloc.is_tracing():
+            tracemalloc.start(25)
+        self.call = reactor.callLater(seconds, self.stop)
+        return True
+
+    def stop(self):
+        if not self.running:
+            return
+        if self.call.active():
+            self.call.cancel()
+        self.call = None
+        if self.mode == 'cprofile':
+            self.profile.disable()
+        else:
+            self.profile.stop()
+        if tracemalloc and tracemalloc.is_tracing():
+            self.snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+        log.info('Finished profiling')
+
+    def dump(self, filename):
+        """ Write out the last profile, returning the files written """
+        if self.profile is None:
+            return []
+        if self.running:
+            self.stop()
+        if self.mode == 'cprofile':
+            self.profile.dump_stats(filename)
+        else:
+            self.profile.dump(filename)
+        written = [filename]
+        if self.snapshot is not None:
+            self.snapshot.dump(filename + '.tracemalloc')
+            written.append(filename + '.tracemalloc')
+        return written
+
+
+def measure(container):
+    """ The number of items in a container, and the bytes that they use """
+    size = sys.getsizeof(container)
+    if isinstance(container, dict):
+        for key, value in container.items():
+            size += sys.getsizeof(key) + sys.getsizeof(value)
+    else:
+        for item in list(container):
+            size += sys.getsizeof(item)
+    return {'items': len(container), 'bytes': size}
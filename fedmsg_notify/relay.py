@@ -0,0 +1,58 @@
+# This file is a part of fedmsg-notify.
+#
+# fedmsg-notify is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# fedmsg-notify is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with fedmsg-notify.  If not, see <http://www.gnu.org/licenses/>.
+
+from twisted.internet import reactor
+
+
+class SignalBatcher(object):
+    """Collects relayed messages to emit them over DBus in batches.
+
+    A batch is emitted once it holds `size` messages, or `delay` seconds
+    after its first message arrived, whichever comes first.
+    """
+
+    def __init__(self, emit, size=64, delay=0.25):
+        self.emit = emit
+        self.size = size
+        self.delay = delay
+        self.pending = []  # [(topic, body)]
+        self.call = None
+        self.batches = self.messages = 0
+
+    def add(self, topic, body):
+        self.pending.append((topic, body))
+        if len(self.pending) >= self.size:
+            self.flush()
+        elif self.call is None:
+            self.call = reactor.callLater(self.delay, self.flush)
+
+    def flush(self):
+        if self.call is not None:
+            if self.call.active():
+                self.call.cancel()
+            self.call = None
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        self.batches += 1
+        self.messages += len(batch)
+        self.emit(batch)
+
+    def stats(self):
+        return {
+            'pending': len(self.pending),
+            'batches': self.batches,
+            'messages': self.messages,
+        }
@@ -0,0 +1,111 @@
+# This file is a part of fedmsg-notify.
+#
+# fedmsg-notify is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# fedmsg-notify is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with fedmsg-notify.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+
+import fedmsg.text
+
+_missing = object()
+
+
+class RenderedMessage(object):
+    """A message along with the text and icons that we render for it.
+
+    Each field is computed by the message's processor the first time it is
+    accessed, and then remembered, so the notification, the DBus relay and
+    our logging can all share one instance without asking fedmsg.text for
+    the same thing twice.
+    """
+    __slots__ = ('body', 'processor', 'config', '_title', '_subtitle',
+                 '_link', '_icon', '_secondary_icon', '_packages', '_repr',
+                 '_json')
+
+    def __init__(self, body, processor, config, raw=None):
+        self.body = body
+        self.processor = processor
+        self.config = config
+        self._title = self._subtitle = self._link = _missing
+        self._icon = self._secondary_icon = _missing
+        self._packages = self._repr = _missing
+        self._json = raw if raw is not None else _missing
+
+    def _render(self, attr, func):
+        value = getattr(self, attr)
+        if value is _missing:
+            value = func(self.body, processor=self.processor, **self.config)
+            setattr(self, attr, value)
+        return value
+
+    @property
+    def msg_id(self):
+        return self.body.get('msg_id')
+
+    @property
+    def topic(self):
+        return self.body.get('topic')
+
+    @property
+    def title(self):
+        return self._render('_title', fedmsg.text.msg2title) or ''
+
+    @property
+    def subtitle(self):
+        return self._render('_subtitle', fedmsg.text.msg2subtitle) or ''
+
+    @property
+    def link(self):
+        return self._render('_link', fedmsg.text.msg2link) or ''
+
+    @property
+    def icon(self):
+        return self._render('_icon', fedmsg.text.msg2icon)
+
+    @property
+    def secondary_icon(self):
+        return self._render('_secondary_icon', fedmsg.text.msg2secondary_icon)
+
+    @property
+    def packages(self):
+        return self._render('_packages', fedmsg.text.msg2packages)
+
+    @property
+    def repr(self):
+        return self._render('_repr', fedmsg.text.msg2repr)
+
+    @property
+    def json(self):
+        """ The message body as JSON, straight off the wire if we have it """
+        if self._json is _missing:
+            self._json = json.dumps(self.body)
+        return self._json
+
+    def render(self):
+        """ Render everything that a notification shows, right now """
+        for attr in ('title', 'subtitle', 'link', 'icon', 'secondary_icon',
+                     'packages'):
+            getattr(self, attr)
+
+    def __eq__(self, other):
+        return (isinstance(other, RenderedMessage) and
+                self.msg_id is not None and self.msg_id == other.msg_id)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.msg_id) if self.msg_id is not None else id(self)
+
+    def __repr__(self):
+        return '<RenderedMessage %s %s>' % (self.msg_id, self.topic)
@@ -0,0 +1,89 @@
+# This file is a part of fedmsg-notify.
+#
+# fedmsg-notify is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# fedmsg-notify is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with fedmsg-notify.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import threading
+
+from collections import OrderedDict
+
+import fedmsg.text
+
+log = logging.getLogger('moksha.hub')
+
+
+class TopicRouter(object):
+    """Maps message topics to the fedmsg.text processor that handles them.
+
+    ``fedmsg.text.msg2processor`` tries every processor's regular expression
+    against the topic until one of them matches. The bus only carries a few
+    hundred distinct topics, so we remember the answer for each of them in a
+    bounded LRU, which turns each lookup into a single dict access.
+
+    Every processor's topic expression is anchored to the processor's own
+    name, so a topic can only ever be handled by the processor that we routed
+    it to. This lets us check the enabled service filters with one regex match
+    against that processor, instead of trying each enabled one in turn.
+
+    Messages can be routed from several threads at once. Only the LRU
+    itself is locked, the regular expressions of a miss run outside it.
+    """
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.lock = threading.Lock()
+        self.routes = OrderedDict()  # {topic: processor}
+        self.services = {}  # {processor name: processor}
+        self.hits = self.misses = 0
+
+    def processor(self, msg):
+        """ Return the processor for this message """
+        topic = msg['topic']
+        with self.lock:
+            processor = self.routes.pop(topic, None)
+            if processor is not None:
+                self.hits += 1
+                self.routes[topic] = processor
+                return processor
+            self.misses += 1
+        processor = fedmsg.text.msg2processor(msg)
+        with self.lock:
+            self.routes.pop(topic, None)
+            if len(self.routes) >= self.size:
+                self.routes.popitem(last=False)
+            self.routes[topic] = processor
+        return processor
+
+    def set_services(self, names):
+        """ Enable the service filters for the processors with these names """
+        self.services = dict((processor.__name__, processor)
+                             for processor in fedmsg.text.processors
+                             if processor.__name__ in names)
+
+    def match_service(self, topic, processor):
+        """ Return the processor if it is an enabled service for this topic """
+        if self.services.get(processor.__name__) is processor:
+            if processor.__prefix__.match(topic):
+                return processor
+
+    def clear(self):
+        with self.lock:
+            self.routes.clear()
+
+    def stats(self):
+        return {
+            'routes': len(self.routes),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
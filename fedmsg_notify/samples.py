@@ -0,0 +1,162 @@
+# This file is a part of fedmsg-notify.
+#
+# fedmsg-notify is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# fedmsg-notify is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with fedmsg-notify.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Sample fedmsg traffic, for trying out the daemon without the real bus.
+
+Messages can either be replayed from a file with one JSON message per line,
+as recorded from datagrepper or ``fedmsg-tail --really-pretty``, or made up
+on the spot by :func:`generate_messages`.
+"""
+
+import sys
+import json
+import time
+import uuid
+import random
+import logging
+import argparse
+
+log = logging.getLogger('moksha.hub')
+
+PREFIX = 'org.fedoraproject.prod'
+
+packages = ['python-%s' % name for name in (
+    'requests', 'six', 'twisted', 'dbus', 'moksha-hub', 'fedmsg', 'kitchen',
+    'psutil', 'sqlalchemy', 'jinja2', 'docutils', 'pygments')] + [
+    'kernel', 'glibc', 'gnome-shell', 'firefox', 'systemd', 'rpm', 'dnf']
+usernames = ['lmacken', 'ralph', 'pingou', 'kevin', 'adamwill', 'sgallagh',
+             'jkeating', 'toshio', 'nirik', 'bodhi', 'releng']
+
+
+def koji_build(package, user, i):
+    return 'buildsys.build.state.change', {
+        'build_id': i, 'name': package, 'owner': user, 'instance': 'primary',
+        'version': '1.%d' % (i % 10), 'release': '1.fc30', 'epoch': None,
+        'old': 0, 'new': random.choice([1, 3]), 'task_id': i * 10,
+        'attribute': 'state',
+    }
+
+
+def bodhi_update(package, user, i):
+    return 'bodhi.update.comment', {
+        'comment': {
+            'author': user, 'karma': 1, 'text': 'Works for me',
+            'update_title': '%s-1.%d-1.fc30' % (package, i % 10),
+        },
+        'agent': user,
+        'update': {
+            'title': '%s-1.%d-1.fc30' % (package, i % 10),
+            'builds': [{'nvr': '%s-1.%d-1.fc30' % (package, i % 10)}],
+            'bugs': [{'bug_id': 1000000 + (i % 500)}],
+            'user': {'name': user}, 'release': {'name': 'F30'},
+        },
+    }
+
+
+def git_receive(package, user, i):
+    return 'git.receive', {
+        'commit': {
+            'repo': package, 'namespace': 'rpms', 'branch': 'master',
+            'username': user, 'agent': user, 'rev': uuid.uuid4().hex,
+            'summary': 'Update to 1.%d' % (i % 10), 'message': '',
+            'stats': {'files': {}, 'total': {}}, 'email': '',
+            'name': user, 'path': '/srv/git/rpms/%s.git' % package,
+            'seen': False,
+        },
+    }
+
+
+def wiki_edit(package, user, i):
+    return 'wiki.article.edit', {
+        'title': package, 'user': user, 'minor_edit': False,
+        'summary': '', 'url': '', 'diff_url': '',
+        'revision': {'rev_id': i},
+    }
+
+
+kinds = [koji_build, bodhi_update, git_receive, wiki_edit]
+
+
+def generate_messages(count, seed=None):
+    """ Generate `count` plausible looking fedmsg messages """
+    rand = random.Random(seed)
+    for i in range(count):
+        kind = rand.choice(kinds)
+        topic, msg = kind(rand.choice(packages), rand.choice(usernames), i)
+        topic = '%s.%s' % (PREFIX, topic)
+        yield {
+            'topic': topic,
+            'msg_id': '%d-%s' % (time.gmtime().tm_year, uuid.uuid4()),
+            'timestamp': time.time(),
+            'i': i,
+            'username': 'apache',
+            'msg': msg,
+        }
+
+
+def load_messages(filename):
+    """ Read recorded messages from a file with one JSON message per line """
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def publish(endpoint, messages, rate=None):
+    """ Publish messages on a ZeroMQ socket, at up to `rate` per second """
+    import zmq
+    context = zmq.Context()
+    socket = context.socket(zmq.PUB)
+    socket.bind(endpoint)
+    # Give subscribers a moment to connect before we start talking
+    time.sleep(1)
+    sent = 0
+    start = time.time()
+    for msg in messages:
+        socket.send_multipart([msg['topic'].encode('utf-8'),
+                               json.dumps(msg).encode('utf-8')])
+        sent += 1
+        if rate:
+            delay = start + sent / float(rate) - time.time()
+            if delay > 0:
+                time.sleep(delay)
+    log.info('Published %d messages in %0.2fs' % (sent, time.time() - start))
+    socket.close(linger=1000)
+    context.term()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Publish sample fedmsg messages on a local socket')
+    parser.add_argument('filename', nargs='?',
+                        help='JSON-lines file of messages to replay')
+    parser.add_argument('--bind', default='tcp://127.0.0.1:9940')
+    parser.add_argument('--count', type=int, default=1000,
+                        help='How many messages to generate without a file')
+    parser.add_argument('--rate', type=float, default=10,
+                        help='Messages per second, 0 for as fast as possible')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+
+    if args.filename:
+        messages = load_messages(args.filename)
+    else:
+        messages = generate_messages(args.count)
+    publish(args.bind, messages, args.rate)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+# This file is a part of fedmsg-notify.
+#
+# fedmsg-notify is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# fedmsg-notify is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with fedmsg-notify.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import random
+import logging
+
+from twisted.internet import reactor
+
+log = logging.getLogger('moksha.hub')
+
+
+class RefreshScheduler(object):
+    """Periodically refreshes the data sets of our filters.
+
+    Each refresh is scheduled `interval` seconds after the previous one
+    finished, give or take `jitter` of it, so that daemons started at the
+    same time don't all query the same servers at once.
+    """
+
+    def __init__(self, jitter=0.1):
+        self.jitter = jitter
+        self.intervals = {}  # {filter: seconds between refreshes}
+        self.calls = {}  # {filter: DelayedCall}
+
+    def add(self, filter, interval):
+        self.remove(filter)
+        if interval > 0:
+            self.intervals[filter] = interval
+            self._schedule(filter)
+
+    def remove(self, filter):
+        self.intervals.pop(filter, None)
+        call = self.calls.pop(filter, None)
+        if call is not None and call.active():
+            call.cancel()
+
+    def _schedule(self, filter):
+        interval = self.intervals[filter]
+        delay = interval * (1 + random.uniform(-self.jitter, self.jitter))
+        self.calls[filter] = reactor.callLater(delay, self._refresh, filter)
+
+    def _refresh(self, filter):
+        del self.calls[filter]
+        log.debug('Refreshing %r' % filter)
+        d = filter.refresh()
+        d.addBoth(self._refreshed, filter)
+
+    def _refreshed(self, result, filter):
+        # The filter may have been disabled while it was refreshing
+        if filter in self.intervals and filter not in self.calls:
+            self._schedule(filter)
+
+    def stats(self):
+        now = time.time()
+        return dict((filter.__class__.__name__, call.getTime() - now)
+                    for filter, call in self.calls.items())
@@ -0,0 +1,75 @@
+# This file is a part of fedmsg-notify.
+#
+# fedmsg-notify is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# fedmsg-notify is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with fedmsg-notify.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import time
+import logging
+
+from .utils import atomic_write, get_cache_dir
+
+log = logging.getLogger('moksha.hub')
+
+
+class Snapshot(object):
+    """A filter's data set, saved to disk between runs.
+
+    `source` describes what the keys were loaded for, such as the usernames
+    whose packages they are, so that a snapshot taken with other settings
+    is never used. The keys are kept as one sorted JSON list, which loads in
+    a few milliseconds even for thousands of packages. The `fingerprint` of
+    whatever the keys were loaded from is kept alongside them, so we can
+    tell whether they need loading again.
+    """
+    version = 1
+
+    def __init__(self, name, source=''):
+        self.filename = os.path.join(get_cache_dir('filters'), name + '.json')
+        self.source = source
+        self.saved = None  # When the snapshot was taken
+        self.fingerprint = None
+
+    def load(self):
+        """ Return the saved keys, or None if there are none to use """
+        try:
+            with open(self.filename) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return
+        if data.get('version') != self.version:
+            return
+        if data.get('source') != self.source:
+            return
+        self.saved = data.get('saved')
+        self.fingerprint = data.get('fingerprint')
+        return set(data.get('keys', ()))
+
+    def save(self, keys, fingerprint=None):
+        self.saved = time.time()
+        self.fingerprint = fingerprint
+        try:
+            atomic_write(self.filename, json.dumps({
+                'version': self.version,
+                'source': self.source,
+                'saved': self.saved,
+                'fingerprint': fingerprint,
+                'keys': sorted(keys),
+            }, separators=(',', ':')))
+        except (IOError, OSError):
+            log.exception('Unable to save %s' % self.filename)
+
+    @property
+    def age(self):
+        return self.saved and time.time() - self.saved
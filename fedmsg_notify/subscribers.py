@@ -0,0 +1,174 @@
+# This file is a part of fedmsg-notify.
+#
+# fedmsg-notify is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# fedmsg-notify is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with fedmsg-notify.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+
+import dbus
+import dbus.service
+
+log = logging.getLogger('moksha.hub')
+
+
+def normalize_prefix(prefix):
+    """ Turn `org.fedoraproject.*` or `org.fedoraproject.` into a dotted prefix """
+    return unicode(prefix).rstrip('*').rstrip('.')
+
+
+def normalize_prefixes(prefixes):
+    """The dotted prefixes of these topics, or none at all for every topic.
+
+    Prefixes are matched against whole parts of the topic, so
+    `org.fedoraproject.prod.bodhi` matches Bodhi's messages but
+    `org.fedoraproject.prod.bod` doesn't match anything.
+    """
+    prefixes = frozenset(normalize_prefix(p) for p in prefixes)
+    if u'' in prefixes:
+        # `*` or an empty prefix asks for every topic
+        return frozenset()
+    return prefixes
+
+
+class Subscription(dbus.service.Object):
+    """A DBus application's subscription to part of the message stream.
+
+    A message matches when its topic starts with one of the `topics`, and
+    it references one of the `packages` or `usernames`. Leaving out the
+    topics, or both the packages and usernames, doesn't restrict on them.
+    Topics are matched on whole dot-separated parts, see
+    :func:`normalize_prefixes`.
+    Matching messages are emitted with the MessageReceived signal on this
+    subscription's own object path.
+    """
+    interface = 'org.fedoraproject.fedmsg.notify.Subscription'
+
+    def __init__(self, conn, path, owner, topics, packages, usernames):
+        dbus.service.Object.__init__(self, conn, path)
+        self.path = path
+        self.owner = owner
+        self.topics = normalize_prefixes(topics)
+        self.packages = frozenset(unicode(p) for p in packages)
+        self.usernames = frozenset(unicode(u) for u in usernames)
+        self.on_unsubscribe = None
+        self.watch = None
+        self.sent = 0
+
+    @dbus.service.signal(dbus_interface=interface, signature='ss')
+    def MessageReceived(self, topic, body):
+        self.sent += 1
+
+    @dbus.service.method(interface)
+    def Unsubscribe(self):
+        if self.on_unsubscribe:
+            self.on_unsubscribe(self)
+
+    def __repr__(self):
+        return '<Subscription %s for %s>' % (self.path, self.owner)
+
+
+class SubscriberIndex(object):
+    """One index of what every DBus subscriber wants.
+
+    Rather than checking each subscription in turn, we look up a message's
+    topic prefixes, packages and usernames in shared tables, so the cost of
+    matching a message doesn't grow with the number of subscribers.
+
+    Subscriptions are added and removed on the main loop, which then
+    publishes frozen copies of the tables as the `view`, so messages can be
+    matched against it from other threads without any locking.
+    """
+
+    def __init__(self):
+        self.subscriptions = set()
+        self.topics = {}  # {topic prefix: set([Subscription])}
+        self.packages = {}
+        self.usernames = {}
+        self.any_topic = set()  # Subscriptions that want every topic
+        self.any_entity = set()  # Subscriptions with no package/username
+        self._publish()
+
+    def add(self, sub):
+        self.subscriptions.add(sub)
+        self._add_keys(self.topics, sub.topics, sub, self.any_topic)
+        self._add_keys(self.packages, sub.packages, sub)
+        self._add_keys(self.usernames, sub.usernames, sub)
+        if not sub.packages and not sub.usernames:
+            self.any_entity.add(sub)
+        self._publish()
+
+    def remove(self, sub):
+        self.subscriptions.discard(sub)
+        self.any_topic.discard(sub)
+        self.any_entity.discard(sub)
+        for table, keys in ((self.topics, sub.topics),
+                            (self.packages, sub.packages),
+                            (self.usernames, sub.usernames)):
+            for key in keys:
+                subs = table.get(key)
+                if subs is not None:
+                    subs.discard(sub)
+                    if not subs:
+                        del table[key]
+        self._publish()
+
+    def _add_keys(self, table, keys, sub, unrestricted=None):
+        if not keys and unrestricted is not None:
+            unrestricted.add(sub)
+        for key in keys:
+            table.setdefault(key, set()).add(sub)
+
+    def _publish(self):
+        def freeze(table):
+            return dict((key, frozenset(subs)) for key, subs in table.items())
+        self.view = (freeze(self.topics), freeze(self.packages),
+                     freeze(self.usernames), frozenset(self.any_topic),
+                     frozenset(self.any_entity))
+
+    def prefixes(self):
+        """ The topic prefixes that our subscribers need, or None for all """
+        if self.any_topic:
+            return None
+        return set(self.topics)
+
+    def match_topic(self, topic, view=None):
+        """ The subscriptions that want messages on this topic """
+        topics, _, _, any_topic, _ = view or self.view
+        matched = set(any_topic)
+        if topics:
+            parts = topic.split('.')
+            for i in range(1, len(parts) + 1):
+                subs = topics.get('.'.join(parts[:i]))
+                if subs:
+                    matched.update(subs)
+        return matched
+
+    def match(self, msg, processor):
+        """ The subscriptions that want this message """
+        view = self.view
+        _, packages, usernames, _, any_entity = view
+        matched = self.match_topic(msg['topic'], view)
+        if not matched:
+            return matched
+        wanted = matched & any_entity
+        if matched - wanted:
+            if packages:
+                for package in processor.packages(msg):
+                    wanted.update(packages.get(package, ()))
+            if usernames:
+                for username in processor.usernames(msg):
+                    wanted.update(usernames.get(username, ()))
+        return matched & wanted
+
+    def __len__(self):
+        return len(self.subscriptions)
@@ -0,0 +1,78 @@
+# This file is a part of fedmsg-notify.
+#
+# fedmsg-notify is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# fedmsg-notify is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with fedmsg-notify.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+
+log = logging.getLogger('moksha.hub')
+
+
+def topic_prefixes(topic, processors, config, extra=()):
+    """Work out the topic prefixes that we need to receive.
+
+    `topic` is the user's topic setting, such as ``org.fedoraproject.*``.
+    When `processors` is None, any message under that topic could match
+    one of our filters. Otherwise, we only need the topics of those fedmsg
+    text processors, plus any `extra` prefixes, that also fall under the
+    user's topic.
+    """
+    base = topic.replace('*', '')
+    if processors is None:
+        return set([base])
+    prefixes = set()
+    wanted = ['.'.join([config['topic_prefix'], config['environment'],
+                        processor.__name__.lower()])
+              for processor in processors]
+    for prefix in wanted + list(extra):
+        if prefix.startswith(base):
+            prefixes.add(prefix)
+        elif base.startswith(prefix):
+            prefixes.add(base)
+    return prefixes
+
+
+class SubscriptionManager(object):
+    """Keeps the hub's ZeroMQ sockets subscribed to only the topics we want.
+
+    ZeroMQ drops messages that don't match a socket's subscriptions before
+    they ever reach Python, so narrowing them saves us from receiving and
+    decoding most of the bus. The subscriptions are changed in place on the
+    existing sockets, without reconnecting.
+    """
+
+    def __init__(self, hub, prefixes):
+        self.hub = hub
+        self.prefixes = set(prefixes)  # What the hub has subscribed to
+
+    def connections(self):
+        for extension in getattr(self.hub, 'extensions', []):
+            for connection in getattr(extension, 'subscriber_factories',
+                                      {}).values():
+                yield connection
+
+    def update(self, prefixes):
+        prefixes = set(prefixes)
+        added, removed = prefixes - self.prefixes, self.prefixes - prefixes
+        if not added and not removed:
+            return
+        for connection in self.connections():
+            for prefix in added:
+                connection.subscribe(prefix.encode('utf-8'))
+            for prefix in removed:
+                connection.unsubscribe(prefix.encode('utf-8'))
+        log.debug('Subscribed to %s' % ', '.join(sorted(prefixes)))
+        self.prefixes = prefixes
+
+    def stats(self):
+        return {'prefixes': sorted(self.prefixes)}
@@ -0,0 +1,54 @@
+# This file is a part of fedmsg-notify.
+#
+# fedmsg-notify is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# fedmsg-notify is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with fedmsg-notify.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import errno
+import tempfile
+
+
+def get_cache_dir(*parts):
+    """ Return (and create) a directory under $XDG_CACHE_HOME/fedmsg-notify """
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    path = os.path.join(base, 'fedmsg-notify', *parts)
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    return path
+
+
+def atomic_write(filename, data):
+    """ Replace the contents of a file without readers seeing a partial write """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+        os.rename(tmp, filename)
+    except:
+        os.unlink(tmp)
+        raise
+
+
+def file_fingerprint(paths):
+    """ Something that changes whenever any of these files change """
+    result = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        result.append([path, st.st_ino, st.st_size, st.st_mtime])
+    return result
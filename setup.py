@@ -21,7 +21,10 @@ setup(
         entry_points={
             'console_scripts':
                 ['fedmsg-notify-config = fedmsg_notify.gui:main',
-                 'fedmsg-notify-daemon = fedmsg_notify.daemon:main'],
+                 'fedmsg-notify-daemon = fedmsg_notify.daemon:main',
+                 'fedmsg-notify-broker = fedmsg_notify.broker:main',
+                 'fedmsg-notify-publisher = fedmsg_notify.samples:main',
+                 'fedmsg-notify-bench = fedmsg_notify.bench:main'],
             'moksha.consumer':
                 ['fedmsg-notify = fedmsg_notify.daemon:FedmsgNotifyService'],
              },)
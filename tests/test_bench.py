@@ -0,0 +1,57 @@
+# This file is a part of fedmsg-notify.
+#
+# fedmsg-notify is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# fedmsg-notify is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with fedmsg-notify.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Run every fedmsg-notify-bench scenario on a handful of messages."""
+
+import json
+import argparse
+import unittest
+
+try:
+    import fedmsg.config
+    import fedmsg.text
+    from fedmsg_notify import bench, daemon
+    from fedmsg_notify.loaders import loaders
+except ImportError:
+    # Needs the daemon's dependencies: fedmsg, fmn, dbus and GTK
+    bench = None
+
+
+@unittest.skipIf(bench is None, "the daemon's dependencies are not installed")
+class TestScenarios(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        daemon.Notify = bench.StubNotify
+        cls.config = fedmsg.config.load_config(None, [])
+        fedmsg.text.make_processors(**cls.config)
+        cls.messages = [(msg['topic'], json.dumps(msg))
+                        for msg in bench.generate_messages(200, 0)]
+        cls.options = argparse.Namespace(seed=0, filters=5)
+
+    @classmethod
+    def tearDownClass(cls):
+        loaders.stop()
+
+    def test_every_scenario(self):
+        for scenario in bench.all_scenarios():
+            result = bench.run_scenario(scenario, self.messages, self.config,
+                                        self.options)
+            self.assertEqual(result['messages'], len(self.messages),
+                             scenario)
+
+
+if __name__ == '__main__':
+    unittest.main()
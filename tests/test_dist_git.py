@@ -0,0 +1,199 @@
+# This file is a part of fedmsg-notify.
+#
+# fedmsg-notify is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# fedmsg-notify is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with fedmsg-notify.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Query a fake dist-git for the packages of users."""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+import unittest
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+
+try:
+    from fedmsg_notify.distro_specific import _fedora
+except ImportError:
+    # Needs the rpm bindings and requests, like on Fedora
+    _fedora = None
+
+
+class FakePagure(ThreadingMixIn, HTTPServer):
+    """ Serves /api/0/user/<name> like src.fedoraproject.org, with ETags """
+    daemon_threads = True
+
+    def __init__(self, users):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FakePagureHandler)
+        self.users = users  # {username: [(namespace, name)]}
+        self.requests = []  # [(username, page, If-None-Match)]
+        self.failing = set()
+        self.lock = threading.Lock()
+        self.active = self.max_active = 0
+        self.delay = 0
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+
+class FakePagureHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        username = url.path.rsplit('/', 1)[-1]
+        query = parse_qs(url.query)
+        page = int(query.get('repopage', ['1'])[0])
+        per_page = int(query.get('per_page', ['20'])[0])
+        with server.lock:
+            server.requests.append((username, page,
+                                    self.headers.get('If-None-Match')))
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        try:
+            time.sleep(server.delay)
+            if username in server.failing:
+                return self.reply(500, b'')
+            repos = server.users[username]
+            start = (page - 1) * per_page
+            body = json.dumps({
+                'repos': [{'namespace': namespace, 'name': name}
+                          for namespace, name in
+                          repos[start:start + per_page]],
+                'repos_pagination': {
+                    'next': (start + per_page < len(repos) and
+                             'page %d' % (page + 1) or None),
+                },
+            }).encode('utf-8')
+            etag = '"%s"' % hashlib.sha1(body).hexdigest()
+            if self.headers.get('If-None-Match') == etag:
+                return self.reply(304, b'', etag)
+            self.reply(200, body, etag)
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def reply(self, code, body, etag=None):
+        self.send_response(code)
+        if etag:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def repos(prefix, count):
+    return [('rpms', '%s-%d' % (prefix, i)) for i in range(count)]
+
+
+@unittest.skipIf(_fedora is None, 'the Fedora bindings are not installed')
+class TestUserPackages(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = tempfile.mkdtemp()
+        self.old_cache = os.environ.get('XDG_CACHE_HOME')
+        os.environ['XDG_CACHE_HOME'] = self.cache
+        self.server = FakePagure({
+            'ralph': repos('ralph', 250) + [('forks', 'ralph-fork'),
+                                            ('modules', 'ralph-module')],
+            'lmacken': repos('lmacken', 30),
+            'rdelinger': repos('rdelinger', 5) + repos('ralph', 2),
+            'kevin': repos('kevin', 120),
+        })
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.old_cache is None:
+            del os.environ['XDG_CACHE_HOME']
+        else:
+            os.environ['XDG_CACHE_HOME'] = self.old_cache
+        shutil.rmtree(self.cache)
+
+    def get(self, usernames, **kw):
+        return _fedora.get_user_packages(usernames, self.server.url, **kw)
+
+    def test_pagination(self):
+        packages = self.get(['ralph'])
+        self.assertEqual(len(packages), 251)
+        self.assertIn('ralph-249', packages)
+        self.assertIn('ralph-module', packages)
+        self.assertNotIn('ralph-fork', packages)
+        pages = [page for user, page, etag in self.server.requests]
+        self.assertEqual(pages, [1, 2, 3])
+
+    def test_cached(self):
+        packages = self.get(['ralph'])
+        del self.server.requests[:]
+        self.assertEqual(self.get(['ralph']), packages)
+        self.assertEqual(self.server.requests, [])
+
+    def test_revalidated(self):
+        packages = self.get(['ralph'])
+        del self.server.requests[:]
+        self.assertEqual(self.get(['ralph'], max_age=0), packages)
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertTrue(all(etag for user, page, etag in
+                            self.server.requests))
+
+    def test_changed(self):
+        self.get(['lmacken'], max_age=0)
+        self.server.users['lmacken'].append(('rpms', 'python-fedmsg'))
+        self.assertIn('python-fedmsg', self.get(['lmacken'], max_age=0))
+
+    def test_parallel(self):
+        self.server.delay = 0.1
+        users = ['ralph', 'lmacken', 'rdelinger', 'kevin']
+        packages = self.get(users)
+        expected = set()
+        for user in users:
+            expected.update(name for namespace, name in self.server.users[user]
+                            if namespace != 'forks')
+        self.assertEqual(packages, expected)
+        self.assertGreater(self.server.max_active, 1)
+
+    def test_failure_uses_cache(self):
+        packages = self.get(['lmacken'])
+        self.server.failing.add('lmacken')
+        self.assertEqual(self.get(['lmacken'], max_age=0), packages)
+        self.assertEqual(self.get(['kevin', 'lmacken'], max_age=0),
+                         packages | self.get(['kevin']))
+
+    def test_failure_without_cache(self):
+        self.server.failing.add('kevin')
+        self.assertEqual(self.get(['kevin', 'lmacken']),
+                         set('lmacken-%d' % i for i in range(30)))
+
+
+if __name__ == '__main__':
+    unittest.main()